@@ -0,0 +1,42 @@
+import pygame
+from cache import LRUCache
+
+ROTATION_STEP = 5.0                # degrees between cached rotations of a sprite
+ROTATION_MEMORY_BUDGET = 16 * 2**20 # bytes of rotated sprites kept around
+
+class AssetManager():
+
+  # AssetManager constructor:
+  # loads every image once, converted to the display's format, and
+  # shares it between everything that asks for it. Rotated versions of
+  # the images are made on demand, at rotation_step degree intervals,
+  # and cached within memory_budget bytes
+  def __init__(self, rotation_step=ROTATION_STEP, memory_budget=ROTATION_MEMORY_BUDGET):
+    self.rotation_step = rotation_step
+    self.images = {} # (path, alpha) -> converted surface
+    self.rotations = LRUCache(memory_budget)
+
+  # load_image: return the image at the given path, loading it on first
+  # use. Images with alpha keep per-pixel transparency; opaque ones
+  # (e.g. tiles) are converted without it, which is faster to blit.
+  # Needs the display mode to be set
+  def load_image(self, image_path, alpha=True):
+    key = (image_path, alpha)
+    if key not in self.images:
+      image = pygame.image.load(image_path)
+      self.images[key] = image.convert_alpha() if alpha else image.convert()
+    return self.images[key]
+
+  # get_rotated: return the image at the given path rotated
+  # counterclockwise by angle degrees, rounded to the rotation step
+  def get_rotated(self, image_path, angle):
+    angle = (round(angle/self.rotation_step)*self.rotation_step) % 360.0
+    key = (image_path, angle)
+    image = self.rotations.get(key)
+    if image is None:
+      image = pygame.transform.rotate(self.load_image(image_path), angle)
+      self.rotations.put(key, image, image.get_width()*image.get_height()*image.get_bytesize())
+    return image
+
+# the asset manager shared by the whole game
+asset_manager = AssetManager()
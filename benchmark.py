@@ -0,0 +1,201 @@
+# benchmark.py: headless microbenchmarks of the lighting, level and
+# camera hot paths. Runs under SDL's dummy video driver, so it needs no
+# window. Usage:
+#   python benchmark.py [--quick] [--output results.json]
+#                       [--baseline baseline.json] [--tolerance 0.2]
+import os, sys, json, random, tempfile, argparse, time
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+from level import Level
+from light import Light
+from camera import Camera
+from lightbuffer import LightBuffer
+from entity import Entity
+from pymunk.vec2d import Vec2d
+
+if hasattr(time, "perf_counter"):
+  clock = time.perf_counter
+else:
+  clock = time.time
+
+SCREEN_WIDTH, SCREEN_HEIGHT = 1000, 1000
+
+# parameter sweeps: (map width, map height, wall density),
+# light counts and light aperture angles
+SWEEPS = { "maps": [(30, 15, 0.1), (100, 100, 0.2), (300, 300, 0.3)],
+           "light_counts": [1, 10, 50],
+           "apertures": [15.0, 30.0, 60.0] }
+QUICK_SWEEPS = { "maps": [(30, 15, 0.1), (100, 100, 0.2)],
+                 "light_counts": [1, 10],
+                 "apertures": [30.0] }
+
+# generate_level: write a random level of the given size, with a solid
+# border and the given fraction of walls inside, and return its path
+def generate_level(width, height, density, seed=0):
+  rand = random.Random(seed)
+  rows = []
+  for y in range(height):
+    rows.append("".join(["#" if (x in (0, width - 1) or y in (0, height - 1) or rand.random() < density)
+                         else "." for x in range(width)]))
+  level_file = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+  level_file.write("\n".join(rows) + "\n")
+  level_file.close()
+  return level_file.name
+
+# time_call: return the best time per call of fn, in seconds, over
+# several repeats of enough calls to take about min_time each
+def time_call(fn, repeat=5, min_time=0.02):
+  number = 1
+  while True:
+    start = clock()
+    for i in range(number):
+      fn()
+    elapsed = clock() - start
+    if elapsed >= min_time or number >= 2**16:
+      break
+    number *= 2
+
+  best = elapsed/number
+  for r in range(repeat - 1):
+    start = clock()
+    for i in range(number):
+      fn()
+    best = min(best, (clock() - start)/number)
+  return best
+
+# make_lights: scatter count lights over the open floor of a level,
+# each shining a little way off from its emitter
+def make_lights(level, count, aperture, seed=0):
+  rand = random.Random(seed)
+  lights = []
+  while len(lights) < count:
+    x = rand.uniform(0, min(level.width*level.tile_dimension, SCREEN_WIDTH))
+    y = rand.uniform(0, min(level.height*level.tile_dimension, SCREEN_HEIGHT))
+    if level.solidity_at((x, y), (x, y))[0].any():
+      continue
+    projection = (x + rand.uniform(-150, 150), y + rand.uniform(-150, 150))
+    light = Light((rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255)),
+                  (x, y), projection, 0.0, aperture)
+    light.update_surface(level)
+    lights.append(light)
+  return lights
+
+def run_benchmarks(sweeps):
+  pygame.init()
+  screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), 0, 32)
+  results = []
+
+  def record(name, params, fn):
+    seconds = time_call(fn)
+    results.append({ "name": name, "params": params, "seconds": seconds })
+    print("%-28s %-50s %10.1f us" % (name, json.dumps(params, sort_keys=True), seconds*1e6))
+
+  for width, height, density in sweeps["maps"]:
+    level_path = generate_level(width, height, density)
+    level = Level(level_path, screen, use_cache=False)
+    os.remove(level_path)
+    map_params = { "map": "%dx%d" % (width, height), "density": density }
+
+    camera = Camera((0, 0), SCREEN_WIDTH, SCREEN_HEIGHT)
+    corners = camera.get_corners()
+    record("Level.tiles_at", map_params, lambda: level.tiles_at((100, 100), (400, 400)))
+    record("Level.draw_visible_level", map_params, lambda: level.draw_visible_level(*corners))
+
+    entity = Entity("resources/robodude.png", screen, make_lights(level, 1, 30.0)[0].emitter_pos, camera)
+    entity.speed = 5
+    def step_entity():
+      entity.vel = Vec2d((1, 0))
+      entity.update(20, level, camera)
+    record("Entity.update", map_params, step_entity)
+
+    rand = random.Random(0)
+    origins = [(rand.uniform(0, width*level.tile_dimension), rand.uniform(0, height*level.tile_dimension))
+               for i in range(256)]
+    targets = [(x + rand.uniform(-400, 400), y + rand.uniform(-400, 400)) for x, y in origins]
+    record("Level.line_of_sight", dict(map_params, rays=len(origins)),
+           lambda: level.line_of_sight(origins, targets))
+
+    for aperture in sweeps["apertures"]:
+      params = dict(map_params, aperture=aperture)
+      light = make_lights(level, 1, aperture)[0]
+      color = light.color
+      record("Light.__init__", params,
+             lambda: Light(color, light.emitter_pos, light.proj_pos, 0.0, aperture))
+      def cold_init():
+        Light.mask_registry.clear()
+        Light(color, light.emitter_pos, light.proj_pos, 0.0, aperture)
+      record("Light.__init__ (cold)", params, cold_init)
+      def update():
+        light.invalidate()
+        light.update_surface(level)
+      record("Light.update_surface", params, update)
+      for mode in Light.SHADOW_MODES:
+        light.shadow_mode = mode
+        record("Light.get_polygon_list", dict(params, shadow_mode=mode),
+               lambda: light.get_polygon_list(level))
+      light.shadow_mode = "edges"
+
+    for count in sweeps["light_counts"]:
+      lights = make_lights(level, count, 30.0)
+      for downsample in LightBuffer.QUALITY_LEVELS:
+        light_buffer = LightBuffer(downsample)
+        record("Camera.render_light", dict(map_params, lights=count, downsample=downsample),
+               lambda: camera.render_light(screen, lights, light_buffer))
+
+      # a second view of the same lighting costs a blit
+      light_buffer = LightBuffer()
+      minimap = Camera((0, 0), SCREEN_WIDTH//4, SCREEN_HEIGHT//4)
+      light_buffer.accumulate([camera.get_corners(), minimap.get_corners()], lights)
+      record("Camera.draw_light", dict(map_params, lights=count),
+             lambda: minimap.draw_light(screen, light_buffer))
+
+  return results
+
+# compare: given this run's results and a baseline's, return the list
+# of (name, params, baseline seconds, seconds) of the benchmarks which
+# got slower than the baseline by more than tolerance
+def compare(results, baseline, tolerance):
+  def key(result):
+    return (result["name"], json.dumps(result["params"], sort_keys=True))
+  baseline_seconds = dict((key(result), result["seconds"]) for result in baseline)
+
+  regressions = []
+  for result in results:
+    before = baseline_seconds.get(key(result))
+    if before and result["seconds"] > before*(1 + tolerance):
+      regressions.append((result["name"], result["params"], before, result["seconds"]))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Headless lightgame microbenchmarks")
+  parser.add_argument("--quick", action="store_true", help="run a smaller parameter sweep")
+  parser.add_argument("--output", default="bench_output.json", help="file to write results to")
+  parser.add_argument("--baseline", help="results file to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.2,
+                      help="slowdown, as a fraction, counted as a regression")
+  args = parser.parse_args()
+  output_path = os.path.abspath(args.output)
+  baseline_path = args.baseline and os.path.abspath(args.baseline)
+  # the game's resources are found relative to it
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+  results = run_benchmarks(QUICK_SWEEPS if args.quick else SWEEPS)
+  output = open(output_path, "w")
+  json.dump({ "results": results }, output, indent=1, sort_keys=True)
+  output.close()
+
+  if baseline_path:
+    baseline_file = open(baseline_path)
+    baseline = json.load(baseline_file)["results"]
+    baseline_file.close()
+    regressions = compare(results, baseline, args.tolerance)
+    for name, params, before, after in regressions:
+      print("REGRESSION %s %s: %.1f us -> %.1f us (%+.0f%%)" %
+            (name, json.dumps(params, sort_keys=True), before*1e6, after*1e6, (after/before - 1)*100))
+    if regressions:
+      sys.exit(1)
+    print("no regressions against %s" % args.baseline)
+
+if __name__ == "__main__":
+  main()
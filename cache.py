@@ -0,0 +1,75 @@
+from collections import OrderedDict
+
+class LRUCache():
+
+  # LRUCache constructor:
+  # max_cost bounds the total cost of everything held in the cache. By
+  # default every entry costs 1, so max_cost is simply the entry count,
+  # but callers can pass e.g. a byte size to put() for a memory budget
+  def __init__(self, max_cost):
+    self.max_cost = max_cost
+    self.entries = OrderedDict() # key -> (value, cost), oldest first
+    self.total_cost = 0
+
+    # counters, for profiling
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  # get: return the value stored under key and mark it as the most
+  # recently used, or return default if it isn't cached
+  def get(self, key, default=None):
+    if key not in self.entries:
+      self.misses += 1
+      return default
+    self.hits += 1
+    entry = self.entries.pop(key)
+    self.entries[key] = entry
+    return entry[0]
+
+  # put: store value under key, evicting the least recently used
+  # entries until the cache fits in its budget again
+  def put(self, key, value, cost=1):
+    if key in self.entries:
+      self.total_cost -= self.entries.pop(key)[1]
+    self.entries[key] = (value, cost)
+    self.total_cost += cost
+    while self.total_cost > self.max_cost and len(self.entries) > 1:
+      self.evict_oldest()
+
+  # evict_oldest: drop the least recently used entry, returning
+  # its (key, value) pair
+  def evict_oldest(self):
+    key, (value, cost) = self.entries.popitem(last=False)
+    self.total_cost -= cost
+    self.evictions += 1
+    return key, value
+
+  # discard: remove key from the cache if present
+  def discard(self, key):
+    if key in self.entries:
+      self.total_cost -= self.entries.pop(key)[1]
+
+  # clear: empty the cache, and reset its counters
+  def clear(self):
+    self.entries.clear()
+    self.total_cost = 0
+    self.reset_stats()
+
+  # get_stats: return the hit/miss/eviction counters along
+  # with the current size of the cache
+  def get_stats(self):
+    return { "hits": self.hits,
+             "misses": self.misses,
+             "evictions": self.evictions,
+             "entries": len(self.entries),
+             "cost": self.total_cost }
+
+  def reset_stats(self):
+    self.hits, self.misses, self.evictions = 0, 0, 0
@@ -1,5 +1,6 @@
 import pygame, math, numpy
 from pymunk import Vec2d
+from lightbuffer import LightBuffer
 
 class Camera():
 
@@ -8,7 +9,7 @@ class Camera():
     self.rypos = init_pos[1]
     self.screen_width = screenwidth
     self.screen_height = screenheight
-    self.shadow_mask = pygame.Surface((self.screen_width, self.screen_height), pygame.SRCALPHA)
+    self.light_buffer = None # made by render_light() when it's first given none
     
   def move(self, newpos):
     # move the camera to a new coordinate position
@@ -42,34 +43,20 @@ class Camera():
     return (rx, ry)
    
  
-  def render_light(self, screen, list_of_lights):
-    screen_width, screen_height = self.screen_width, self.screen_height
-    
-    # fill screen with darkness, full alpha
-    self.shadow_mask.fill((1,1,1,255)) 
-    
-    # for every light that's visible on screen, subtract that alpha value
-    # from the darkness
-    for light in list_of_lights:
-      # offset the center by the rotated surface's dimensions
-      realwidth = light.alpha_surface.get_rect().width
-      realheight = light.alpha_surface.get_rect().height
-      xoffset_pos = light.proj_pos.x - realwidth/2
-      yoffset_pos = light.proj_pos.y - realheight/2
+  # render_light: light this camera's view on its own into light_buffer
+  # (a full resolution one of the camera's own, if None), and draw it
+  # onto the screen. With several views, accumulate them all into a
+  # shared LightBuffer once, and draw_light() each instead
+  def render_light(self, screen, list_of_lights, light_buffer=None):
+    if light_buffer is None:
+      if self.light_buffer is None:
+        self.light_buffer = LightBuffer()
+      light_buffer = self.light_buffer
+    light_buffer.accumulate([self.get_corners()], list_of_lights)
+    return self.draw_light(screen, light_buffer)
 
-      # get the screen position of the surface
-      light_spos = self.real_to_screen(xoffset_pos, yoffset_pos)
-      
-      self.shadow_mask.blit(light.alpha_surface, light_spos, None, pygame.BLEND_RGBA_SUB)
-          
-      self.shadow_mask.blit(light.color_surface, light_spos, None, pygame.BLEND_RGB_ADD)
-      
-    # given the camera's visibility, remove unseeable light by adding full
-    # alpha to non-visible areas
-      for r_polygon in light.polylist:
-        s_polygon = map(lambda p: self.real_to_screen(p[0], p[1]), r_polygon)
-        pygame.draw.polygon(self.shadow_mask, (1,1,1,255), s_polygon, 0)
-        
-    # Finally, blit the light layer onto the screen
-    screen.blit(self.shadow_mask, (0,0))
-        
+  # draw_light: blit this camera's part of a LightBuffer, accumulated
+  # this frame over a set of views including this one, onto the screen
+  # at dest
+  def draw_light(self, screen, light_buffer, dest=(0, 0)):
+    return light_buffer.draw(screen, self.get_corners(), dest)
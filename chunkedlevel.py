@@ -0,0 +1,289 @@
+import numpy, struct, threading
+import tile
+from tile import Tile
+from cache import LRUCache
+from profiler import clock
+from level import Level, TILE_DIMENSION, BAKED_MEMORY_BUDGET, merged_edges, parse_level_line
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+CHUNK_DIMENSION = 64           # size, in tiles, of the side of a chunk
+PREFETCH_MARGIN = 1            # chunks loaded ahead around every active box
+MEMORY_BUDGET = 16 * 2**20     # bytes of chunk data kept resident
+
+# chunk file format: a fixed-size header, followed by every chunk's
+# CHUNK_DIMENSIONxCHUNK_DIMENSION type codes, row of chunks by row of
+# chunks, so that any chunk can be read (or memory mapped) directly
+CHUNK_FILE_MAGIC = b"LGCHUNK1"
+CHUNK_FILE_HEADER = struct.Struct("<8sIII") # magic, width, height, chunk dimension
+CHUNK_FILE_HEADER_SIZE = 32
+
+class ChunkedLevel(Level):
+
+  # ChunkedLevel constructor:
+  # takes the screen and a file-path to a chunk file made by
+  # compile_chunk_file(). Only the chunks around the boxes given to
+  # update_residency() are kept in memory, within memory_budget bytes;
+  # they're loaded ahead of time by a background thread, until close()
+  def __init__(self, chunk_path, screen, memory_budget=MEMORY_BUDGET):
+    start = clock()
+    Tile.load_images()
+    self.screen = screen
+    self.level_path = chunk_path
+    self.tile_dimension = TILE_DIMENSION
+    self.load_times = { "images": (clock() - start)*1000.0 }
+
+    start = clock()
+    self.load_source = "chunks"
+    self.width, self.height, self.chunk_dimension = read_chunk_file_header(chunk_path)
+    self.chunk_file = open_chunk_file(chunk_path)
+    self.load_times["open"] = (clock() - start)*1000.0
+
+    self.solid_table = ~tile.get_attribute_table("movethrough", True)
+    self.opaque_table = ~tile.get_attribute_table("shinethrough", True)
+    self.baked_chunks = LRUCache(BAKED_MEMORY_BUDGET)
+    self.version = 0
+    self.region_versions = {}
+    self.tile_edits = {}
+
+    # (chunk x, chunk y) -> [y][x] array of type codes
+    self.resident_chunks = LRUCache(memory_budget)
+    self.modified_chunks = {} # chunks changed by set_tile(), which are never evicted
+    self.pending_chunks = set()
+    self.chunk_lock = threading.Lock()
+    self.chunk_requests = queue.Queue()
+    self.loader = threading.Thread(target=self.load_requested_chunks)
+    self.loader.daemon = True
+    self.loader.start()
+
+  # load_requested_chunks:
+  # The background loader's loop, which reads every chunk
+  # requested by update_residency() into memory, until it's
+  # sent None by close()
+  def load_requested_chunks(self):
+    while True:
+      key = self.chunk_requests.get()
+      if key is None:
+        return
+      chunk = self.read_chunk(key)
+      with self.chunk_lock:
+        if key not in self.resident_chunks:
+          self.resident_chunks.put(key, chunk, chunk.nbytes)
+        self.pending_chunks.discard(key)
+
+  def read_chunk(self, key):
+    cx, cy = key
+    return numpy.array(self.chunk_file[cy, cx])
+
+  # get_chunk:
+  # Return the type codes of a chunk, reading it right away
+  # if the background loader hasn't got to it yet
+  def get_chunk(self, cx, cy):
+    key = (cx, cy)
+    with self.chunk_lock:
+      chunk = self.modified_chunks.get(key)
+      if chunk is None:
+        chunk = self.resident_chunks.get(key)
+    if chunk is None:
+      chunk = self.read_chunk(key)
+      with self.chunk_lock:
+        self.resident_chunks.put(key, chunk, chunk.nbytes)
+    return chunk
+
+  # update_residency:
+  # Queue up every chunk within PREFETCH_MARGIN chunks of the given
+  # boxes for loading, and mark the resident ones as recently used
+  def update_residency(self, boxes):
+    chunk_dim = self.chunk_dimension * TILE_DIMENSION
+    chunks_y, chunks_x = self.chunk_file.shape[:2]
+    wanted = set()
+    for (x1, y1), (x2, y2) in boxes:
+      for cy in range(max(0, int(y1 // chunk_dim) - PREFETCH_MARGIN),
+                      min(chunks_y, int(y2 // chunk_dim) + PREFETCH_MARGIN + 1)):
+        for cx in range(max(0, int(x1 // chunk_dim) - PREFETCH_MARGIN),
+                        min(chunks_x, int(x2 // chunk_dim) + PREFETCH_MARGIN + 1)):
+          wanted.add((cx, cy))
+
+    with self.chunk_lock:
+      for key in wanted:
+        if key in self.resident_chunks:
+          self.resident_chunks.get(key)
+        elif key not in self.pending_chunks:
+          self.pending_chunks.add(key)
+          self.chunk_requests.put(key)
+
+  # set_code:
+  # Changed chunks move out of the resident cache, so they're kept
+  # for as long as the level is
+  def set_code(self, x, y, code):
+    dim = self.chunk_dimension
+    key = (x // dim, y // dim)
+    chunk = self.get_chunk(*key)
+    with self.chunk_lock:
+      self.modified_chunks[key] = chunk
+    old_code = chunk[y % dim, x % dim]
+    chunk[y % dim, x % dim] = code
+    return old_code
+
+  # rebuild_occluder_region:
+  # Occluders are merged on the fly, so there's nothing to rebuild
+  def rebuild_occluder_region(self, bx, by):
+    pass
+
+  def codes_in(self, x_lower, x_upper, y_lower, y_upper):
+    x_upper, y_upper = min(x_upper, self.width), min(y_upper, self.height)
+    codes = numpy.empty((max(0, y_upper - y_lower), max(0, x_upper - x_lower)), dtype=numpy.uint8)
+    if not codes.size:
+      return codes
+
+    # copy in the overlapping part of every chunk the bounds cross
+    dim = self.chunk_dimension
+    for cy in range(y_lower // dim, (y_upper - 1) // dim + 1):
+      for cx in range(x_lower // dim, (x_upper - 1) // dim + 1):
+        x0, x1 = max(x_lower, cx*dim), min(x_upper, (cx + 1)*dim)
+        y0, y1 = max(y_lower, cy*dim), min(y_upper, (cy + 1)*dim)
+        codes[y0-y_lower:y1-y_lower, x0-x_lower:x1-x_lower] = \
+          self.get_chunk(cx, cy)[y0-cy*dim:y1-cy*dim, x0-cx*dim:x1-cx*dim]
+    return codes
+
+  def solid_in(self, x_lower, x_upper, y_lower, y_upper):
+    return self.solid_table[self.codes_in(x_lower, x_upper, y_lower, y_upper)]
+
+  def opaque_in(self, x_lower, x_upper, y_lower, y_upper):
+    return self.opaque_table[self.codes_in(x_lower, x_upper, y_lower, y_upper)]
+
+  # occluders_at:
+  # There's no level-wide edge index, so merge the edges of the tiles
+  # under the box (plus a border of their neighbours) on the fly
+  def occluders_at(self, box_top_left_corner, box_bot_right_corner):
+    x_lower, x_upper, y_lower, y_upper = self.index_bounds(box_top_left_corner, box_bot_right_corner)
+    x_upper, y_upper = max(x_upper, x_lower), max(y_upper, y_lower)
+
+    # anything outside the map counts as opaque
+    opaque = numpy.ones((y_upper - y_lower + 2, x_upper - x_lower + 2), dtype=bool)
+    x_start, y_start = max(x_lower - 1, 0), max(y_lower - 1, 0)
+    inside = self.opaque_in(x_start, x_upper + 1, y_start, y_upper + 1)
+    opaque[y_start-y_lower+1:y_start-y_lower+1+inside.shape[0],
+           x_start-x_lower+1:x_start-x_lower+1+inside.shape[1]] = inside
+    edges, normals = merged_edges(opaque, x_lower, y_lower)
+
+    (x1, y1), (x2, y2) = box_top_left_corner, box_bot_right_corner
+    touching = ((edges[:, 0] <= x2) & (edges[:, 2] >= x1) &
+                (edges[:, 1] <= y2) & (edges[:, 3] >= y1))
+    return edges[touching], normals[touching]
+
+  # get_occluder_snapshot:
+  # The level itself holds a lock and a thread, so it can't be sent to
+  # worker processes; see ChunkedOccluderSnapshot
+  def get_occluder_snapshot(self):
+    return ChunkedOccluderSnapshot(self)
+
+  # close:
+  # Stop the background loader, and wait for it to finish
+  def close(self):
+    if self.loader is not None:
+      self.chunk_requests.put(None)
+      self.loader.join()
+      self.loader = None
+
+class ChunkedOccluderSnapshot(ChunkedLevel):
+
+  # ChunkedOccluderSnapshot constructor:
+  # takes a ChunkedLevel, and keeps what shadow geometry needs from it:
+  # the path of its chunk file, and copies of the chunks set_tile() has
+  # changed. Other chunks are read straight from the file, mapped again
+  # wherever the snapshot is used, with no loader thread or lock, so a
+  # snapshot can be pickled and sent to worker processes
+  def __init__(self, level):
+    self.level_path = level.level_path
+    self.tile_dimension = level.tile_dimension
+    self.width, self.height, self.chunk_dimension = level.width, level.height, level.chunk_dimension
+    self.solid_table, self.opaque_table = level.solid_table, level.opaque_table
+    self.version = level.version
+    self.region_versions = dict(level.region_versions)
+    self.tile_edits = {}
+    with level.chunk_lock:
+      self.modified_chunks = dict((key, chunk.copy()) for key, chunk in level.modified_chunks.items())
+    self.chunk_file = None
+
+  # the memory map is made again after unpickling, rather than copied
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state["chunk_file"] = None
+    return state
+
+  def get_chunk(self, cx, cy):
+    chunk = self.modified_chunks.get((cx, cy))
+    if chunk is None:
+      if self.chunk_file is None:
+        self.chunk_file = open_chunk_file(self.level_path)
+      chunk = self.chunk_file[cy, cx]
+    return chunk
+
+  def set_code(self, x, y, code):
+    dim = self.chunk_dimension
+    key = (x // dim, y // dim)
+    if key not in self.modified_chunks:
+      self.modified_chunks[key] = numpy.array(self.get_chunk(*key))
+    chunk = self.modified_chunks[key]
+    old_code = chunk[y % dim, x % dim]
+    chunk[y % dim, x % dim] = code
+    return old_code
+
+  def invalidate_tiles(self, x_lower, x_upper, y_lower, y_upper):
+    pass
+
+  def update_residency(self, boxes):
+    pass
+
+  def close(self):
+    pass
+
+# Given the file path for a level text file, write it out as a chunk
+# file. The text is read a band of chunks at a time, so the level
+# never needs to fit in memory
+def compile_chunk_file(level_path, chunk_path, chunk_dim=CHUNK_DIMENSION):
+  level_file = open(level_path)
+  width, height = 0, 0
+  for line in level_file:
+    width, height = max(width, len(line.strip())), height + 1
+  level_file.seek(0)
+
+  chunks_x, chunks_y = -(-width // chunk_dim), -(-height // chunk_dim)
+  out = open(chunk_path, "wb")
+  out.write(CHUNK_FILE_HEADER.pack(CHUNK_FILE_MAGIC, width, height, chunk_dim).ljust(CHUNK_FILE_HEADER_SIZE, b"\0"))
+
+  char_codes = tile.get_code_table()
+  band = numpy.empty((chunk_dim, chunks_x*chunk_dim), dtype=numpy.uint8)
+  lines = iter(level_file)
+  for cy in range(chunks_y):
+    band[:] = tile.EMPTY
+    for y in range(min(chunk_dim, height - cy*chunk_dim)):
+      codes = parse_level_line(next(lines).strip(), char_codes)
+      band[y, :len(codes)] = codes
+    chunks = band.reshape(chunk_dim, chunks_x, chunk_dim).swapaxes(0, 1)
+    out.write(numpy.ascontiguousarray(chunks).tobytes())
+
+  out.close()
+  level_file.close()
+
+# Return the (width, height) of the level in a chunk file, in
+# tiles, along with the dimension of its chunks
+def read_chunk_file_header(chunk_path):
+  chunk_file = open(chunk_path, "rb")
+  header = chunk_file.read(CHUNK_FILE_HEADER.size)
+  chunk_file.close()
+  magic, width, height, chunk_dim = CHUNK_FILE_HEADER.unpack(header)
+  if magic != CHUNK_FILE_MAGIC:
+    raise ValueError("%s is not a chunk file" % chunk_path)
+  return width, height, chunk_dim
+
+# Memory map a chunk file, returning a read-only array
+# indexed [chunk y][chunk x][y][x]
+def open_chunk_file(chunk_path):
+  width, height, chunk_dim = read_chunk_file_header(chunk_path)
+  chunks_x, chunks_y = -(-width // chunk_dim), -(-height // chunk_dim)
+  return numpy.memmap(chunk_path, dtype=numpy.uint8, mode="r", offset=CHUNK_FILE_HEADER_SIZE,
+                      shape=(chunks_y, chunks_x, chunk_dim, chunk_dim))
@@ -0,0 +1,75 @@
+import pygame
+
+class DirtyRectRenderer():
+  FULL_UPDATE_FRACTION = 0.5 # flip the whole display once the dirty
+                             #   area covers this much of the screen
+
+  # DirtyRectRenderer constructor:
+  # takes the screen. Every frame, mark what was drawn with
+  # mark_entity()/mark_light()/mark_level(), then present() the frame
+  def __init__(self, screen):
+    self.screen_rect = screen.get_rect()
+    self.rects = []      # rects marked this frame
+    self.last_rects = [] # rects marked last frame, which need restoring
+    self.last_view = None
+    self.needs_full_update = True
+    self.level_version = None # version of the level as of the last mark_level()
+
+    # counters, for profiling
+    self.full_updates = 0
+    self.partial_updates = 0
+
+  # mark: mark a screen-space rect as changed this frame
+  def mark(self, rect):
+    rect = pygame.Rect(rect).clip(self.screen_rect)
+    if rect.width and rect.height:
+      self.rects.append(rect)
+
+  def mark_entity(self, entity, currentCam):
+    self.mark(entity.get_screen_rect(currentCam))
+
+  # mark_light: mark the area a light can change. Outside of its
+  # projection, the light's shadow polygons only darken what is already
+  # fully dark, so the projection rect covers its shadows too. In a
+  # buffer downsample times smaller than the screen, lights are placed
+  # on whole buffer pixels, and upscaling can spread them by one more,
+  # so the rect is padded by two buffer pixels
+  def mark_light(self, light, currentCam, downsample=1):
+    (left, top), (right, bot) = light.get_projection_bounds()
+    sx, sy = currentCam.real_to_screen(left, top)
+    pad = 2*downsample
+    self.mark((sx - pad, sy - pad, right - left + 1 + 2*pad, bot - top + 1 + 2*pad))
+
+  # mark_level: mark the tiles set_tile() has changed since the last
+  # call, which a still camera would otherwise never push
+  def mark_level(self, level, currentCam):
+    if self.level_version is not None:
+      dim = level.tile_dimension
+      for x, y, code in level.get_edits_since(self.level_version):
+        sx, sy = currentCam.real_to_screen(x*dim, y*dim)
+        self.mark((sx, sy, dim, dim))
+    self.level_version = level.version
+
+  # invalidate: make the next present() update the whole display,
+  # e.g. after something not tracked by marks has changed
+  def invalidate(self):
+    self.needs_full_update = True
+
+  # present: push this frame to the display. Only the rects marked this
+  # frame and last frame are updated, unless the camera has moved or
+  # been switched, in which case every pixel may have changed
+  def present(self, currentCam):
+    view = (id(currentCam), currentCam.get_corners())
+    rects = self.rects + self.last_rects
+    dirty_area = sum([rect.width*rect.height for rect in rects])
+    if (self.needs_full_update or view != self.last_view or
+        dirty_area > self.FULL_UPDATE_FRACTION*self.screen_rect.width*self.screen_rect.height):
+      pygame.display.flip()
+      self.full_updates += 1
+    else:
+      pygame.display.update(rects)
+      self.partial_updates += 1
+
+    self.last_view = view
+    self.last_rects, self.rects = self.rects, []
+    self.needs_full_update = False
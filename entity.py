@@ -1,104 +1,153 @@
 import pygame, math
+from assets import asset_manager
 from camera import Camera
 from light import Light
 from pygame.sprite import Sprite
 from pymunk.vec2d import Vec2d
 
 class Entity(Sprite):
+  SPEED_TIME_UNIT = 20.0 # ms; speed is in pixels moved per this much time
+  ROTATE_IMAGES = True   # turned off by headless runs, which never draw
+
   def __init__(self, image_path, screen, initpos, camera):
     Sprite.__init__(self)
     self.camera = camera
     self.screen = screen
     self.rpos = Vec2d(initpos)
+    self.last_rpos = Vec2d(initpos)  # position before the last update
+    self.render_pos = Vec2d(initpos) # position drawn at, see interpolate()
     self.vel = Vec2d((0,0))
     self.lights = []
+    self.light_index = None # LightIndex this entity's lights are filed in, if any
+    self.light_pool = None  # LightPool this entity's lights are updated on, if any
     
-    self.image = pygame.image.load(image_path)
+    self.image_path = image_path
+    self.image = asset_manager.load_image(image_path)
     #store original size for consistent hitboxes (rotating changes image size)
     self.original_image_size = self.image.get_size() 
-    self.base_image = self.image #for use in rotations
     
   def draw(self, currentCam):
+    # draw the entity to the screen coordinates
+    self.screen.blit(self.image, self.get_screen_rect(currentCam))
+
+  # get_screen_rect: return the rect the entity's image
+  # covers on the screen, as seen from currentCam
+  def get_screen_rect(self, currentCam):
     image_w, image_h = self.image.get_size()
     
     # adjust real to screen coordinates based on currentCam:
     #   screen_x = real_x - dist_realOrigin_to_screenOrigin_x
     #   screen_y = real_y - dist_realOrigin_to_screenOrigin_y
     
-    sx, sy = currentCam.real_to_screen(self.rpos.x, self.rpos.y)
+    sx, sy = currentCam.real_to_screen(self.render_pos.x, self.render_pos.y)
  
-    # draw the entity to the screen coordinates
-    draw_pos = self.image.get_rect().move(
+    return self.image.get_rect().move(
         sx - image_w / 2,
         sy - image_h / 2)
-    self.screen.blit(self.image, draw_pos)
   
   def update(self, time_passed, level, currentCam):
-    # update the position based on the normalized velocity * speed
-    # unless the entity is about to move into a solid tile
+    # move by the normalized velocity * speed, scaled to the time passed,
+    # as far as the entity can go before a solid tile
+    dx, dy = level.sweep_box(self.get_collision_box(), self.get_move(time_passed))
+    self.last_rpos = Vec2d(self.rpos)
+    self.rpos.x += dx
+    self.rpos.y += dy
+    self.vel = Vec2d((0,0))
+
+  # get_collision_box: return the [left, top, right, bottom] box the
+  # entity takes up in the level, which doesn't change as it rotates
+  def get_collision_box(self):
     image_w, image_h = self.original_image_size
+    return [self.rpos.x - image_w/2.0, self.rpos.y - image_h/2.0,
+            self.rpos.x + image_w/2.0, self.rpos.y + image_h/2.0]
 
-    newrx = self.rpos.x + self.vel.x * self.speed
-    new_topleft_corner = (newrx - image_w/2, self.rpos.y - image_h/2)
-    new_botright_corner = (newrx + image_w/2, self.rpos.y + image_h/2)
-    tiles_to_be_occupied = level.tiles_at(new_topleft_corner, new_botright_corner)
-    problem_tiles = [tile for tile in tiles_to_be_occupied if not tile.attributes["movethrough"]] 
-    if problem_tiles == []: 
-      self.rpos.x = newrx
-      
-    newry = self.rpos.y + self.vel.y * self.speed
-    new_topleft_corner = (self.rpos.x - image_w/2, newry - image_h/2)
-    new_botright_corner = (self.rpos.x + image_w/2, newry + image_h/2)
-    tiles_to_be_occupied = level.tiles_at(new_topleft_corner, new_botright_corner)
-    problem_tiles = [tile for tile in tiles_to_be_occupied if not tile.attributes["movethrough"]] 
-    if problem_tiles == []: 
-      self.rpos.y = newry
+  # get_move: return the (dx, dy) the entity wants to move by, which is
+  # the normalized velocity * speed, scaled to the time passed
+  def get_move(self, time_passed):
+    distance = self.speed * time_passed / self.SPEED_TIME_UNIT
+    return (self.vel.x * distance, self.vel.y * distance)
 
-    self.vel = Vec2d((0,0))
+  # interpolate: given how far, from 0 to 1, the time being drawn is
+  # between the last update and the next one, place the entity that far
+  # between its last two positions
+  def interpolate(self, alpha):
+    self.render_pos = self.last_rpos + (self.rpos - self.last_rpos) * alpha
+
+  # update_view: bring everything which is only drawn, not simulated, in
+  # line with the entity's interpolated position, once per drawn frame
+  def update_view(self, alpha, level, currentCam, mouse_pos=None):
+    self.interpolate(alpha)
+    self.update_lights(level)
+
+  # register_lights: file this entity's lights in a LightIndex, after
+  # which only the ones near its views get updated. Given a LightPool,
+  # their updates are submitted to it rather than made right away
+  def register_lights(self, light_index, light_pool=None):
+    self.light_index = light_index
+    self.light_pool = light_pool
+    for light in self.lights:
+      light_index.insert(light)
+
+  # update_lights: with the entity's lights moved into place,
+  # redraw the ones which might be seen
+  def update_lights(self, level):
+    for light in self.lights:
+      if self.light_index is not None:
+        self.light_index.move(light)
+        if not self.light_index.is_visible(light):
+          continue
+      if self.light_pool is not None:
+        self.light_pool.submit(light, level)
+      else:
+        light.update_surface(level)
     
 class Player(Entity):
   def __init__(self, image_path, screen, initpos, camera):
     super(Player, self).__init__(image_path, screen, initpos, camera)
     self.speed = 5
-    self.base_image = pygame.transform.rotate(self.image, 180)
+    self.base_angle = 180.0 # the image faces away from where the player aims
     self.flashlight = Light((0,0,0), self.rpos, self.rpos, 0.0, 30.0)
     self.headlight = Light((255,0,0), self.rpos, self.rpos, 0.0, 50.0)
     
     self.lights.append(self.headlight)
     self.lights.append(self.flashlight)
     
-  def update(self, time_passed, level, currentCam):
-    super(Player, self).update(time_passed, level, currentCam)
+  # update_view: as Entity.update_view, and aim at the mouse, given in
+  # screen coordinates. Without mouse_pos, the real mouse is used
+  def update_view(self, alpha, level, currentCam, mouse_pos=None):
+    self.interpolate(alpha)
+    
+    # offset the camera location to place the player
+    # in the middle of the screen
+    offsetX = self.render_pos.x - self.camera.screen_width/2
+    offsetY = self.render_pos.y - self.camera.screen_height/2
+
+    self.camera.move((offsetX, offsetY))
     
     # draw a vector between the player and the cursor
     # and rotate the player image to face it.
     # Have to use the current camera in order
     # to get the player's screen coordinates, (sx, sy)
-    sx, sy = currentCam.real_to_screen(self.rpos.x, self.rpos.y)
-    mouse_sx, mouse_sy = pygame.mouse.get_pos()
+    sx, sy = currentCam.real_to_screen(self.render_pos.x, self.render_pos.y)
+    if mouse_pos is None:
+      mouse_pos = pygame.mouse.get_pos()
+    mouse_sx, mouse_sy = mouse_pos
     mouse_rx, mouse_ry = currentCam.screen_to_real(mouse_sx, mouse_sy)
 
     dx = sx - mouse_sx
     dy = sy - mouse_sy
     player_to_mouse = Vec2d(dx, dy)
 
-    self.image = pygame.transform.rotate(self.base_image, -math.degrees(player_to_mouse.angle)) 
+    if self.ROTATE_IMAGES:
+      self.image = asset_manager.get_rotated(self.image_path, self.base_angle - math.degrees(player_to_mouse.angle))
     
     # with the entity's position updated, bring the light emitter with it
-    self.flashlight.emitter_pos = self.rpos
+    self.flashlight.emitter_pos = self.render_pos
     self.flashlight.proj_pos = Vec2d(mouse_rx, mouse_ry) 
-    self.flashlight.update_surface(level)
     
-    self.headlight.emitter_pos = self.rpos
-    self.headlight.proj_pos = self.rpos
-    self.headlight.update_surface(level)
-    
-    # offset the camera location to place the player
-    # in the middle of the screen
-    offsetX = self.rpos.x - self.camera.screen_width/2
-    offsetY = self.rpos.y - self.camera.screen_height/2
-
-    self.camera.move((offsetX, offsetY))
+    self.headlight.emitter_pos = self.render_pos
+    self.headlight.proj_pos = self.render_pos
+    self.update_lights(level)
     
    
   def movement_handler(self, keydown):
@@ -106,5 +155,16 @@ class Player(Entity):
                                 pygame.K_s: (self.vel.x, 1),
                                 pygame.K_a: (-1, self.vel.y),
                                 pygame.K_d: (1, self.vel.y)}[keydown]
-      self.vel = self.vel.normalized() 
+      self.vel = self.vel.normalized()
 
+# update_entities: the batched version of Entity.update. Move every
+# entity as far along its velocity as it can go before a solid tile,
+# resolving all their collisions with the level in one sweep
+def update_entities(entities, time_passed, level):
+  boxes = [entity.get_collision_box() for entity in entities]
+  moves = [entity.get_move(time_passed) for entity in entities]
+  for entity, (dx, dy) in zip(entities, level.sweep_boxes(boxes, moves).tolist()):
+    entity.last_rpos = Vec2d(entity.rpos)
+    entity.rpos.x += dx
+    entity.rpos.y += dy
+    entity.vel = Vec2d((0,0))
@@ -0,0 +1,226 @@
+import pygame, numpy
+from assets import asset_manager
+from entity import Entity
+from pymunk.vec2d import Vec2d
+
+class EntityStore():
+  INITIAL_CAPACITY = 64
+  HASH_CELL_SIZE = 64   # size, in pixels, of the spatial hash cells used
+                        #   to find overlapping entities
+
+  # EntityStore constructor:
+  # keeps a crowd of simple entities in contiguous arrays, so that all
+  # of them can be moved, collided and drawn with a handful of array
+  # operations. Rows are either plain store entities, which keep
+  # walking in their direction and turn back off walls, or members: full
+  # Entity objects (e.g. the Player) whose position and velocity are
+  # copied in and out around every step
+  def __init__(self, screen, capacity=INITIAL_CAPACITY):
+    self.screen = screen
+    self.count = 0
+    self.positions = numpy.zeros((capacity, 2))
+    self.last_positions = numpy.zeros((capacity, 2))  # positions before the last step
+    self.render_positions = numpy.zeros((capacity, 2)) # positions drawn at, see interpolate()
+    self.velocities = numpy.zeros((capacity, 2))       # normalized directions
+    self.speeds = numpy.zeros(capacity)                # pixels per Entity.SPEED_TIME_UNIT
+    self.sizes = numpy.zeros((capacity, 2))            # width, height of the collision box
+    self.image_ids = numpy.zeros(capacity, dtype=int)  # index into images, or -1 to not draw
+    self.ids = numpy.zeros(capacity, dtype=int)        # stable id of the entity in each row
+
+    self.images = []      # every image used, shared by all rows
+    self.image_paths = {} # image path -> index in images
+    self.rows = {}        # id -> row
+    self.members = {}     # id -> Entity, for rows which stand in for one
+    self.next_id = 0
+
+    # lights which follow store entities: the id of the entity each one
+    # follows, and the offset of its projection from the entity
+    self.lights = []
+    self.light_owners = numpy.zeros(0, dtype=int)
+    self.light_offsets = numpy.zeros((0, 2))
+
+  def __len__(self):
+    return self.count
+
+  def load_image(self, image_path):
+    if image_path not in self.image_paths:
+      self.image_paths[image_path] = len(self.images)
+      self.images.append(asset_manager.load_image(image_path))
+    return self.image_paths[image_path]
+
+  # grow: make room for at least one more row
+  def grow(self):
+    capacity = len(self.positions)
+    if self.count < capacity:
+      return
+    for name in ("positions", "last_positions", "render_positions", "velocities", "speeds",
+                 "sizes", "image_ids", "ids"):
+      old = getattr(self, name)
+      new = numpy.zeros((capacity*2,) + old.shape[1:], dtype=old.dtype)
+      new[:capacity] = old
+      setattr(self, name, new)
+
+  # add: add an entity to the store, returning its id
+  def add(self, position, velocity, speed, size, image_path=None):
+    self.grow()
+    row = self.count
+    self.count += 1
+    self.positions[row] = self.last_positions[row] = self.render_positions[row] = position
+    self.velocities[row] = velocity
+    self.speeds[row] = speed
+    self.sizes[row] = size
+    self.image_ids[row] = self.load_image(image_path) if image_path else -1
+    self.ids[row] = self.next_id
+    self.rows[self.next_id] = row
+    self.next_id += 1
+    return self.ids[row]
+
+  # add_member: add an Entity to the store, which moves it along with
+  # everything else from then on. Returns its id
+  def add_member(self, entity):
+    entity_id = self.add(tuple(entity.rpos), (0, 0), entity.speed, entity.original_image_size)
+    self.members[entity_id] = entity
+    return entity_id
+
+  # remove: remove an entity, moving the last row into its place
+  def remove(self, entity_id):
+    row = self.rows.pop(entity_id)
+    self.members.pop(entity_id, None)
+    self.count -= 1
+    last = self.count
+    if row != last:
+      for array in (self.positions, self.last_positions, self.render_positions, self.velocities,
+                    self.speeds, self.sizes, self.image_ids, self.ids):
+        array[row] = array[last]
+      self.rows[self.ids[row]] = row
+
+    # its lights go with it
+    keep = self.light_owners != entity_id
+    self.lights = [light for light, kept in zip(self.lights, keep.tolist()) if kept]
+    self.light_owners, self.light_offsets = self.light_owners[keep], self.light_offsets[keep]
+
+  # attach_light: make a light follow an entity, shining offset away
+  # from it
+  def attach_light(self, entity_id, light, offset=(0, 0)):
+    self.lights.append(light)
+    self.light_owners = numpy.append(self.light_owners, entity_id)
+    self.light_offsets = numpy.vstack((self.light_offsets, offset))
+
+  # get_boxes: return the [left, top, right, bottom] collision boxes of
+  # every row, around the given positions
+  def get_boxes(self, positions=None):
+    if positions is None:
+      positions = self.positions[:self.count]
+    half = self.sizes[:self.count]/2.0
+    return numpy.hstack((positions - half, positions + half))
+
+  # step: the batched version of Entity.update, for every row at once.
+  # Members move by their own velocities, which are then reset like
+  # Entity.update does. Store entities which walk into a wall turn back
+  def step(self, time_passed, level):
+    count = self.count
+    member_rows = [self.rows[entity_id] for entity_id in self.members]
+    for row, entity in zip(member_rows, self.members.values()):
+      self.positions[row] = (entity.rpos.x, entity.rpos.y)
+      self.velocities[row] = (entity.vel.x, entity.vel.y)
+      self.speeds[row] = entity.speed
+
+    positions = self.positions[:count]
+    velocities = self.velocities[:count]
+    moves = velocities * (self.speeds[:count] * time_passed / Entity.SPEED_TIME_UNIT)[:, numpy.newaxis]
+    resolved = level.sweep_boxes(self.get_boxes(), moves)
+    self.last_positions[:count] = positions
+    positions += resolved
+
+    velocities[resolved != moves] *= -1
+    for row, entity in zip(member_rows, self.members.values()):
+      entity.last_rpos = Vec2d(tuple(self.last_positions[row]))
+      entity.rpos.x, entity.rpos.y = self.positions[row].tolist()
+      entity.vel = Vec2d((0,0))
+      velocities[row] = 0
+
+  # interpolate: the batched version of Entity.interpolate
+  def interpolate(self, alpha):
+    count = self.count
+    last = self.last_positions[:count]
+    self.render_positions[:count] = last + (self.positions[:count] - last) * alpha
+
+  # get_overlaps: return an (M, 2) array of the [lower id, higher id]
+  # pairs of entities whose boxes overlap. Entities are hashed into
+  # HASH_CELL_SIZE cells, and only those sharing a cell are compared
+  def get_overlaps(self):
+    count = self.count
+    boxes = self.get_boxes()
+    cells = numpy.floor(boxes/self.HASH_CELL_SIZE).astype(int)
+    spans = cells[:, 2:] - cells[:, :2] + 1
+
+    # one (cell, row) entry for every cell each box covers
+    covered = spans[:, 0]*spans[:, 1]
+    rows = numpy.repeat(numpy.arange(count), covered)
+    offsets = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(covered) - covered, covered)
+    cell_x = cells[rows, 0] + offsets % spans[rows, 0]
+    cell_y = cells[rows, 1] + offsets // spans[rows, 0]
+    order = numpy.lexsort((rows, cell_y, cell_x))
+    cell_x, cell_y, rows = cell_x[order], cell_y[order], rows[order]
+
+    # pair up every two entries in the same cell
+    pairs = [numpy.zeros((0, 2), dtype=int)]
+    distance = 1
+    while distance < len(rows):
+      same = (cell_x[distance:] == cell_x[:-distance]) & (cell_y[distance:] == cell_y[:-distance])
+      if not same.any():
+        break
+      pairs.append(numpy.column_stack((rows[:-distance][same], rows[distance:][same])))
+      distance += 1
+    pairs = numpy.vstack(pairs)
+    if not len(pairs):
+      return pairs
+
+    a, b = pairs[:, 0], pairs[:, 1]
+    touching = ((boxes[a, 0] < boxes[b, 2]) & (boxes[b, 0] < boxes[a, 2]) &
+                (boxes[a, 1] < boxes[b, 3]) & (boxes[b, 1] < boxes[a, 3]))
+    ids = numpy.sort(self.ids[pairs[touching]], axis=1)
+    if not len(ids):
+      return ids
+    return numpy.unique(ids, axis=0)
+
+  # update_lights: the batched version of Entity.update_lights, for the
+  # lights following store entities
+  def update_lights(self, level, light_index=None, light_pool=None):
+    if not self.lights:
+      return
+    rows = numpy.array([self.rows[entity_id] for entity_id in self.light_owners.tolist()])
+    emitters = self.render_positions[rows]
+    projections = emitters + self.light_offsets
+    for light, emitter, projection in zip(self.lights, emitters.tolist(), projections.tolist()):
+      light.emitter_pos = Vec2d(emitter)
+      light.proj_pos = Vec2d(projection)
+      if light_index is not None:
+        light_index.move(light)
+        if not light_index.is_visible(light):
+          continue
+      if light_pool is not None:
+        light_pool.submit(light, level)
+      else:
+        light.update_surface(level)
+
+  # draw: draw every store entity on screen as seen from currentCam, in
+  # one batch, and return the rects drawn over. Members draw themselves
+  def draw(self, currentCam):
+    count = self.count
+    image_ids = self.image_ids[:count]
+    drawn = image_ids >= 0
+    if not drawn.any():
+      return []
+    sizes = numpy.array([image.get_size() for image in self.images], dtype=float)[image_ids[drawn]]
+    (left, top), (right, bot) = currentCam.get_corners()
+    topleft = self.render_positions[:count][drawn] - sizes/2.0 - (left, top)
+    on_screen = ((topleft[:, 0] < right - left) & (topleft[:, 1] < bot - top) &
+                 (topleft[:, 0] + sizes[:, 0] > 0) & (topleft[:, 1] + sizes[:, 1] > 0))
+
+    images = self.images
+    blits = [(images[image_id], position) for image_id, position in
+             zip(image_ids[drawn][on_screen].tolist(), topleft[on_screen].astype(int).tolist())]
+    if hasattr(self.screen, "blits"):
+      return self.screen.blits(blits)
+    return [self.screen.blit(image, position) for image, position in blits]
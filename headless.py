@@ -0,0 +1,121 @@
+# headless.py: run the game's simulation as fast as the CPU allows,
+# without drawing anything, e.g. for validating levels or training AI
+# over thousands of episodes. The player is driven by a programmatic
+# input source; collision and light geometry are kept, but nothing is
+# blitted and no surfaces are transformed. Runs under SDL's dummy video
+# driver, so it needs no display. Usage:
+#   python headless.py [--level testlevel.txt] [--frames 1000]
+#                      [--worlds 1] [--processes N] [--npcs 0]
+import os, sys, argparse, multiprocessing
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+from random import Random
+from entity import Entity
+from level import Level
+from light import Light
+from world import World, WASD_KEYS
+from profiler import clock
+
+STEP_TIME = 20.0           # ms simulated per frame, as at the game's SIMULATION_HZ
+VIEW_SIZE = (1000, 1000)   # size of the views lights are culled against, as in the game
+
+class RandomInput():
+  MIN_HOLD = 5   # frames each choice of keys is held for, at least
+  MAX_HOLD = 50  #   and at most
+
+  # RandomInput constructor:
+  # a stand-in for a player, which holds random movement keys for random
+  # stretches of frames, and moves the mouse to a random spot of the
+  # view with each. The same seed always gives the same input.
+  # Input sources give the (held keys, mouse position in screen
+  # coordinates) of a frame through get_input()
+  def __init__(self, seed=None, view_size=VIEW_SIZE):
+    self.rand = Random(seed)
+    self.view_size = view_size
+    self.held_keys = []
+    self.mouse_pos = (view_size[0]//2, view_size[1]//2)
+    self.frames_left = 0
+
+  def get_input(self, frame):
+    if self.frames_left <= 0:
+      self.held_keys = self.rand.sample(WASD_KEYS, self.rand.randint(0, 2))
+      self.mouse_pos = (self.rand.randint(0, self.view_size[0] - 1), self.rand.randint(0, self.view_size[1] - 1))
+      self.frames_left = self.rand.randint(self.MIN_HOLD, self.MAX_HOLD)
+    self.frames_left -= 1
+    return self.held_keys, self.mouse_pos
+
+# set_headless: make this process's lights and entities skip all the
+# work which only matters for drawing, and set up a dummy display for
+# the images which are still loaded
+def set_headless():
+  Light.BUILD_SURFACES = False
+  Entity.ROTATE_IMAGES = False
+  pygame.init()
+  return pygame.display.set_mode((1, 1))
+
+# run_world: simulate one world for the given number of frames, one
+# fixed step and one light update each, with input from input_source
+# (a seeded RandomInput, if None). Returns a dict of how it went
+def run_world(level_path, frames, seed=0, npc_count=0, input_source=None):
+  screen = set_headless()
+  world = World(level_path, screen, VIEW_SIZE, npc_count, seed=seed)
+  if input_source is None:
+    input_source = RandomInput(seed)
+
+  start = clock()
+  for frame in range(frames):
+    held_keys, mouse_pos = input_source.get_input(frame)
+    world.step(STEP_TIME, held_keys)
+    world.update_view(1.0, held_keys, mouse_pos)
+    world.gather_lights()
+  seconds = clock() - start
+
+  return { "seed": seed,
+           "frames": frames,
+           "seconds": seconds,
+           "fps": frames/seconds if seconds else float("inf"),
+           "player_pos": tuple(world.player.rpos) }
+
+def run_world_job(job):
+  return run_world(*job)
+
+# run_worlds: simulate count independent worlds, seeded 0 to count-1,
+# on a pool of processes. Returns the list of run_world() results
+def run_worlds(level_path, frames, count, processes=None, npc_count=0):
+  # compile the level once up front, so the workers all load it from
+  # the cache rather than racing to write it
+  Level(level_path, set_headless())
+
+  jobs = [(level_path, frames, seed, npc_count) for seed in range(count)]
+  if count == 1:
+    return [run_world_job(jobs[0])]
+  pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+  try:
+    return pool.map(run_world_job, jobs)
+  finally:
+    pool.close()
+    pool.join()
+
+def main():
+  parser = argparse.ArgumentParser(description="Headless lightgame simulation")
+  parser.add_argument("--level", help="level file to simulate, by default the test level")
+  parser.add_argument("--frames", type=int, default=1000, help="frames to simulate per world")
+  parser.add_argument("--worlds", type=int, default=1, help="independent worlds to simulate")
+  parser.add_argument("--processes", type=int, help="worker processes, default one per CPU")
+  parser.add_argument("--npcs", type=int, default=0, help="wandering robots per world")
+  args = parser.parse_args()
+  level_path = os.path.abspath(args.level) if args.level else "testlevel.txt"
+  # the game's resources (and the test level) are found relative to it
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+  start = clock()
+  results = run_worlds(level_path, args.frames, args.worlds, args.processes, args.npcs)
+  elapsed = clock() - start
+  for result in results:
+    print("world %(seed)d: %(frames)d frames in %(seconds).2f s, %(fps).0f simulated fps" % result)
+  total = sum([result["frames"] for result in results])
+  print("%d frames in %.2f s: %.0f simulated fps overall" % (total, elapsed, total/elapsed))
+
+if __name__ == "__main__":
+  main()
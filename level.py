@@ -1,66 +1,414 @@
-import pygame, sys, os, math
+import pygame, sys, os, math, numpy, hashlib
+import tile
 from tile import Tile
+from cache import LRUCache
+from profiler import clock
 from pygame.sprite import Sprite
 
 TILE_DIMENSION = 32
+OCCLUDER_BUCKET_DIMENSION = 8 # size, in tiles, of the regions occluder edges are kept
+                              #   (and rebuilt, when tiles change) by
+BAKED_CHUNK_DIMENSION = 16    # size, in tiles, of the pre-rendered tile surfaces
+BAKED_MEMORY_BUDGET = 32 * 2**20 # bytes of pre-rendered tile surfaces kept around
+LEVEL_CACHE_DIR = ".levelcache" # compiled levels are kept here, next to their source
+LEVEL_CACHE_VERSION = 2         # bump whenever the compiled format changes
 
 class Level():
   
   # Level constructor:
   # takes the secreen and a file-path to the text file
-  # which contains the level
-  def __init__(self, level_path, screen):
+  # which contains the level. The parsed level and everything derived
+  # from it are compiled into LEVEL_CACHE_DIR, and loaded from there
+  # while the text file is unchanged, unless use_cache is False.
+  # How long each part took is kept in load_times, in ms
+  def __init__(self, level_path, screen, use_cache=True):
+    start = clock()
     Tile.load_images()
     self.screen = screen
     self.level_path = level_path
-    self.tiles = self.parse_level() #2D array containing tile codes (ints)
+    self.tile_dimension = TILE_DIMENSION
+    self.load_times = { "images": (clock() - start)*1000.0 }
+
+    # type code -> whether tiles of that type are solid / opaque
+    self.solid_table = ~tile.get_attribute_table("movethrough", True)
+    self.opaque_table = ~tile.get_attribute_table("shinethrough", True)
+
+    compiled_path = None
+    if use_cache:
+      start = clock()
+      compiled_path = get_compiled_level_path(level_path)
+      self.load_times["hash"] = (clock() - start)*1000.0
+
+    start = clock()
+    if compiled_path and self.load_compiled(compiled_path):
+      self.load_source = "cache"
+      self.load_times["load"] = (clock() - start)*1000.0
+    else:
+      self.load_source = "text"
+      self.grid = self.parse_level() #2D array containing tile codes (uint8)
+      self.load_times["parse"] = (clock() - start)*1000.0
+      start = clock()
+      self.build_derived()
+      self.load_times["derive"] = (clock() - start)*1000.0
+      if compiled_path:
+        start = clock()
+        self.save_compiled(compiled_path)
+        self.load_times["save"] = (clock() - start)*1000.0
+
+    self.baked_chunks = LRUCache(BAKED_MEMORY_BUDGET)
+
+    # every set_tile() call bumps version, and marks the occluder regions
+    # around the tile with it, so cached results can tell if they're stale
+    self.version = 0
+    self.region_versions = {} # (bx, by) -> version of the last change there
+    self.tile_edits = {}      # (x, y) -> (version, code) of the last change there
+
+  # build_derived:
+  # Build everything which is derived from the type grid
+  def build_derived(self):
+    self.height, self.width = self.grid.shape
+
+    # per-cell attribute grids, indexed [y][x]
+    self.solid = self.solid_table[self.grid]
+    self.opaque = self.opaque_table[self.grid]
+    self.occluder_regions = self.build_occluder_regions()
+
+  # load_compiled / save_compiled:
+  # Read the type grid and everything derived from it from a compiled
+  # level file, returning whether it could be read, or write them out
+  # to one. Occluder regions are stored as their keys, and the edges
+  # and normals of every region one after another
+  def load_compiled(self, compiled_path):
+    try:
+      compiled = numpy.load(compiled_path)
+      if compiled["version"] != LEVEL_CACHE_VERSION:
+        return False
+      self.grid = compiled["grid"]
+      self.solid, self.opaque = compiled["solid"], compiled["opaque"]
+      region_keys, region_ends = compiled["region_keys"], compiled["region_ends"][:-1]
+      region_edges = numpy.split(compiled["occluder_edges"], region_ends)
+      region_normals = numpy.split(compiled["occluder_normals"], region_ends)
+      compiled.close()
+    except (IOError, OSError, KeyError, ValueError):
+      return False
+
+    self.height, self.width = self.grid.shape
+    self.occluder_regions = dict(zip([tuple(key) for key in region_keys.tolist()],
+                                     zip(region_edges, region_normals)))
+    return True
+
+  def save_compiled(self, compiled_path):
+    keys = sorted(self.occluder_regions)
+    edges = [self.occluder_regions[key][0] for key in keys]
+    normals = [self.occluder_regions[key][1] for key in keys]
+    try:
+      if not os.path.isdir(os.path.dirname(compiled_path)):
+        os.makedirs(os.path.dirname(compiled_path))
+      # drop the stale compiled versions of this level
+      prefix = os.path.basename(compiled_path).rsplit("-", 1)[0] + "-"
+      for name in os.listdir(os.path.dirname(compiled_path)):
+        if name.startswith(prefix):
+          os.remove(os.path.join(os.path.dirname(compiled_path), name))
+      compiled_file = open(compiled_path, "wb")
+      numpy.savez(compiled_file, version=LEVEL_CACHE_VERSION, grid=self.grid,
+                  solid=self.solid, opaque=self.opaque,
+                  region_keys=numpy.array(keys, dtype=int).reshape(-1, 2),
+                  region_ends=numpy.cumsum([len(e) for e in edges], dtype=int),
+                  occluder_edges=numpy.concatenate(edges + [numpy.zeros((0, 4))]),
+                  occluder_normals=numpy.concatenate(normals + [numpy.zeros((0, 2))]))
+      compiled_file.close()
+    except (IOError, OSError):
+      pass # the level still works, it will just be compiled again next time
+
+  # get_load_report: return a one line summary of how the level was
+  # loaded, and how long it took
+  def get_load_report(self):
+    total = sum(self.load_times.values())
+    parts = ", ".join(["%s %.1f ms" % (name, self.load_times[name]) for name in sorted(self.load_times)])
+    return "%s: %dx%d tiles from %s in %.1f ms (%s)" % (self.level_path, self.width, self.height,
+                                                       self.load_source, total, parts)
     
   # parse_level:
   # Given the file path for the level text file,
-  # return a 2D array containing all tiles. Coordinates
-  # of each tile are positioned at their top left corner
+  # return a 2D array containing the type code of every
+  # tile, indexed [y][x]. Short rows are padded with EMPTY
   def parse_level(self):
-    level_file = open(self.level_path)
-    map_so_far = []
-    x = 0
-    y = 0
-    for line in level_file:
-      x = 0
-      map_row = []
-      for char in list(line.strip()):
-        this_tile = Tile(self.screen, x, y, char, TILE_DIMENSION)
-        map_row.append(this_tile)    
-        x = x+TILE_DIMENSION
-      map_so_far.append(map_row)
-      y = y+TILE_DIMENSION
-    
-    level_file.close()
-    return map_so_far
+    return parse_level_file(self.level_path)
   
+  # build_occluder_regions:
+  # Collapse the outline of all opaque tiles into merged edge segments,
+  # see merged_edges(), and file them under the OCCLUDER_BUCKET_DIMENSION
+  # sized square region of the tile they belong to. Edges are broken at
+  # region borders, so that every region's edges can be rebuilt on their
+  # own. Anything outside the map counts as opaque
+  def build_occluder_regions(self):
+    opaque = numpy.ones((self.height + 2, self.width + 2), dtype=bool)
+    opaque[1:-1, 1:-1] = self.opaque
+    edges, normals = merged_edges(opaque, 0, 0, OCCLUDER_BUCKET_DIMENSION)
+
+    # the tile behind each edge, and so its region
+    owners = numpy.column_stack((edges[:, 0]//TILE_DIMENSION - (normals[:, 0] > 0),
+                                 edges[:, 1]//TILE_DIMENSION - (normals[:, 1] > 0)))
+    regions = (owners // OCCLUDER_BUCKET_DIMENSION).astype(int)
+    order = numpy.lexsort((regions[:, 0], regions[:, 1]))
+    edges, normals, regions = edges[order], normals[order], regions[order]
+    starts = numpy.nonzero((regions[1:] != regions[:-1]).any(axis=1))[0] + 1
+    keys = [tuple(region) for region in regions[numpy.append(0, starts)].tolist()] if len(regions) else []
+    return dict(zip(keys, zip(numpy.split(edges, starts), numpy.split(normals, starts))))
+
+  # build_occluder_region:
+  # Return the (edges, normals) of a single occluder region
+  def build_occluder_region(self, bx, by):
+    dim = OCCLUDER_BUCKET_DIMENSION
+    x_index, y_index = bx*dim, by*dim
+    opaque = numpy.ones((dim + 2, dim + 2), dtype=bool)
+    x_start, y_start = max(x_index - 1, 0), max(y_index - 1, 0)
+    inside = self.opaque_in(x_start, x_index + dim + 1, y_start, y_index + dim + 1)
+    opaque[y_start - y_index + 1:y_start - y_index + 1 + inside.shape[0],
+           x_start - x_index + 1:x_start - x_index + 1 + inside.shape[1]] = inside
+    edges, normals = merged_edges(opaque, x_index, y_index)
+
+    # cells past the edge of the map are opaque, but have no edges
+    owner_x = edges[:, 0]//TILE_DIMENSION - (normals[:, 0] > 0)
+    owner_y = edges[:, 1]//TILE_DIMENSION - (normals[:, 1] > 0)
+    inside = (owner_x < self.width) & (owner_y < self.height)
+    return edges[inside], normals[inside]
+
+  # occluders_at:
+  # Given a bounding box in real coordinates, return the (edges, normals)
+  # arrays of the occluder edges which touch it
+  def occluders_at(self, box_top_left_corner, box_bot_right_corner):
+    region_dim = OCCLUDER_BUCKET_DIMENSION * TILE_DIMENSION
+    x1, y1 = box_top_left_corner
+    x2, y2 = box_bot_right_corner
+    # edges on a region border belong to the region on either side
+    found = [self.occluder_regions[(bx, by)]
+             for by in range(int((y1 - 1) // region_dim), int((y2 + 1) // region_dim) + 1)
+             for bx in range(int((x1 - 1) // region_dim), int((x2 + 1) // region_dim) + 1)
+             if (bx, by) in self.occluder_regions]
+    if not found:
+      return numpy.zeros((0, 4)), numpy.zeros((0, 2))
+
+    edges = numpy.concatenate([region_edges for region_edges, region_normals in found])
+    normals = numpy.concatenate([region_normals for region_edges, region_normals in found])
+    touching = ((edges[:, 0] <= x2) & (edges[:, 2] >= x1) &
+                (edges[:, 1] <= y2) & (edges[:, 3] >= y1))
+    return edges[touching], normals[touching]
+
+  # set_tile:
+  # Change the type of the tile at the given [y][x] indexes, and bring
+  # everything derived from it up to date: the collision and opacity
+  # grids, the occluder regions around it and the baked surface it's in.
+  # Cached light shadows notice the change through version_at().
+  # Raises IndexError for indexes outside the level
+  def set_tile(self, x, y, tile_type):
+    if not (0 <= x < self.width and 0 <= y < self.height):
+      raise IndexError("tile (%d, %d) is outside the %dx%d level" % (x, y, self.width, self.height))
+    self.set_tile_code(x, y, tile.type_codes[tile_type])
+
+  # set_tile_code:
+  # set_tile(), given a type code rather than a type name
+  def set_tile_code(self, x, y, code):
+    if self.set_code(x, y, code) == code:
+      return
+    self.version += 1
+    self.tile_edits[(x, y)] = (self.version, code)
+
+    # the tile's edges, and those of its neighbours facing it, may change
+    dim = OCCLUDER_BUCKET_DIMENSION
+    for by in range(max(y - 1, 0) // dim, (y + 1) // dim + 1):
+      for bx in range(max(x - 1, 0) // dim, (x + 1) // dim + 1):
+        self.region_versions[(bx, by)] = self.version
+        self.rebuild_occluder_region(bx, by)
+    self.invalidate_tiles(x, x + 1, y, y + 1)
+
+  # set_code:
+  # Write a type code into the grids, returning the code it replaces
+  def set_code(self, x, y, code):
+    old_code = self.grid[y, x]
+    self.grid[y, x] = code
+    self.solid[y, x] = self.solid_table[code]
+    self.opaque[y, x] = self.opaque_table[code]
+    return old_code
+
+  # get_edits_since:
+  # Return the (x, y, type code) of every tile set_tile() has changed
+  # since the given version, as it is now. Renderers and occluder
+  # snapshots catch up with the level through these
+  def get_edits_since(self, version):
+    return [(x, y, code) for (x, y), (edit_version, code) in self.tile_edits.items() if edit_version > version]
+
+  # apply_edits:
+  # Given edits from get_edits_since(), and the version of the level
+  # they were taken at, bring this copy of the level up to it
+  def apply_edits(self, edits, version):
+    for x, y, code in edits:
+      self.set_tile_code(x, y, code)
+    self.version = version
+
+  def rebuild_occluder_region(self, bx, by):
+    edges, normals = self.build_occluder_region(bx, by)
+    if len(edges):
+      self.occluder_regions[(bx, by)] = (edges, normals)
+    else:
+      self.occluder_regions.pop((bx, by), None)
+
+  # version_at:
+  # Given a box in real coordinates, return the version of the last
+  # set_tile() call which could have changed anything inside it
+  def version_at(self, box_top_left_corner, box_bot_right_corner):
+    if not self.region_versions:
+      return 0
+    region_dim = OCCLUDER_BUCKET_DIMENSION * TILE_DIMENSION
+    x1, y1 = box_top_left_corner
+    x2, y2 = box_bot_right_corner
+    return max([self.region_versions.get((bx, by), 0)
+                for by in range(int((y1 - 1) // region_dim), int((y2 + 1) // region_dim) + 1)
+                for bx in range(int((x1 - 1) // region_dim), int((x2 + 1) // region_dim) + 1)])
+
+  # update_residency:
+  # Given the (top left, bottom right) boxes, in real coordinates, of
+  # everything currently looking at or lighting the level, make sure
+  # the tiles around them are at hand. The whole of a Level always is
+  def update_residency(self, boxes):
+    pass
+
+  # close:
+  # Release whatever the level holds on to besides memory. A Level
+  # holds nothing else
+  def close(self):
+    pass
+
+  # codes_in / solid_in / opaque_in:
+  # Given [y][x] index bounds, return the sub-grid of type codes /
+  # solidity / opacity they cover, clipped to the level
+  def codes_in(self, x_lower, x_upper, y_lower, y_upper):
+    return self.grid[y_lower:y_upper, x_lower:x_upper]
+
+  def solid_in(self, x_lower, x_upper, y_lower, y_upper):
+    return self.solid[y_lower:y_upper, x_lower:x_upper]
+
+  def opaque_in(self, x_lower, x_upper, y_lower, y_upper):
+    return self.opaque[y_lower:y_upper, x_lower:x_upper]
+
+  # get_tile:
+  # Given the [y][x] indexes of a cell, create and return the
+  # Tile in it, or -1 if there isn't one
+  def get_tile(self, x, y):
+    codes = self.codes_in(x, x+1, y, y+1)
+    if codes.size and codes[0][0] != tile.EMPTY:
+      return Tile(self.screen, x*TILE_DIMENSION, y*TILE_DIMENSION,
+                  tile.type_names[codes[0][0]], TILE_DIMENSION)
+    return -1
+
   def tile_at(self, coordinates):
     x = naturalize(coordinates[0]/TILE_DIMENSION)
     y = naturalize(coordinates[1]/TILE_DIMENSION)
     
-    if y < len(self.tiles):
-      if x < len(self.tiles[y]):
-        return self.tiles[y][x]
-      
-    return -1
+    return self.get_tile(x, y)
   
-  def tiles_at(self, box_top_left_corner, box_bot_right_corner):
+  # index_bounds:
+  # Given a box in real coordinates, return the
+  # (x_lower, x_upper, y_lower, y_upper) slice bounds
+  # of the grid cells it covers
+  def index_bounds(self, box_top_left_corner, box_bot_right_corner):
     x_lower_bound = naturalize(box_top_left_corner[0]/TILE_DIMENSION )
     x_upper_bound = naturalize(box_bot_right_corner[0]/TILE_DIMENSION +1)
     y_lower_bound = naturalize(box_top_left_corner[1]/TILE_DIMENSION )
     y_upper_bound = naturalize(box_bot_right_corner[1]/TILE_DIMENSION +1)
+    
+    return (x_lower_bound, x_upper_bound, y_lower_bound, y_upper_bound)
+
+  def tiles_at(self, box_top_left_corner, box_bot_right_corner):
+    x_lower, x_upper, y_lower, y_upper = self.index_bounds(box_top_left_corner, box_bot_right_corner)
     tiles = []
     
-    for row in self.tiles[y_lower_bound:y_upper_bound]:
-      for tile in row[x_lower_bound:x_upper_bound]:
-        #tile.image = pygame.image.load("resources/robodude.png")
-        tiles.append(tile)
+    for y, row in enumerate(self.codes_in(x_lower, x_upper, y_lower, y_upper).tolist(), y_lower):
+      for x, code in enumerate(row, x_lower):
+        if code != tile.EMPTY:
+          tiles.append(Tile(self.screen, x*TILE_DIMENSION, y*TILE_DIMENSION,
+                            tile.type_names[code], TILE_DIMENSION))
         
     return tiles
   
+  # solidity_at / opacity_at:
+  # The array versions of tiles_at, for hot callers. Given a box in
+  # real coordinates, return the boolean sub-grid, indexed [y][x], of
+  # the cells which can't be moved / shone through, along with the
+  # (x, y) index of its top left cell
+  def solidity_at(self, box_top_left_corner, box_bot_right_corner):
+    x_lower, x_upper, y_lower, y_upper = self.index_bounds(box_top_left_corner, box_bot_right_corner)
+    return self.solid_in(x_lower, x_upper, y_lower, y_upper), (x_lower, y_lower)
+
+  def opacity_at(self, box_top_left_corner, box_bot_right_corner):
+    x_lower, x_upper, y_lower, y_upper = self.index_bounds(box_top_left_corner, box_bot_right_corner)
+    return self.opaque_in(x_lower, x_upper, y_lower, y_upper), (x_lower, y_lower)
+
+  # sweep_box:
+  # The single box version of sweep_boxes. Given a [left, top, right,
+  # bottom] box and the (dx, dy) it wants to move, return the move it
+  # can make
+  def sweep_box(self, box, move):
+    left, top, right, bot = box
+    dx, dy = move
+    dx = self.sweep_span(left, right, top, bot, dx, True)
+    dy = self.sweep_span(top, bot, left + dx, right + dx, dy, False)
+    return (dx, dy)
+
+  # sweep_span:
+  # Given a box's half-open extent along an axis and across it, return
+  # how far it can move delta along the axis before the first solid cell
+  # it would newly enter
+  def sweep_span(self, lower, upper, across_lower, across_upper, delta, along_x):
+    if delta > 0:
+      first, last = int(math.ceil(upper/TILE_DIMENSION)), int(math.ceil((upper + delta)/TILE_DIMENSION))
+    elif delta < 0:
+      first, last = int(math.floor((lower + delta)/TILE_DIMENSION)), int(math.floor(lower/TILE_DIMENSION))
+    else:
+      return delta
+    first = max(first, 0)
+    across_first = max(int(math.floor(across_lower/TILE_DIMENSION)), 0)
+    across_last = int(math.ceil(across_upper/TILE_DIMENSION))
+    if last <= first or across_last <= across_first:
+      return delta
+
+    if along_x:
+      hits = numpy.flatnonzero(self.solid_in(first, last, across_first, across_last).any(axis=0))
+    else:
+      hits = numpy.flatnonzero(self.solid_in(across_first, across_last, first, last).any(axis=1))
+    if not len(hits):
+      return delta
+    if delta > 0:
+      return float((first + hits[0])*TILE_DIMENSION - upper)
+    return float((first + hits[-1] + 1)*TILE_DIMENSION - lower)
+
+  # sweep_boxes:
+  # Given an (N, 4) array of [left, top, right, bottom] boxes in real
+  # coordinates and an (N, 2) array of the (dx, dy) each one wants to
+  # move, return the (N, 2) moves they can make without entering a solid
+  # cell. Boxes move along x, then along y, and stop flush against the
+  # first solid cell in their way, however far they move in one call.
+  # Boxes are half-open, so a box flush against a wall doesn't touch it
+  def sweep_boxes(self, boxes, moves):
+    boxes = numpy.asarray(boxes, dtype=float).reshape(-1, 4)
+    moves = numpy.array(moves, dtype=float).reshape(-1, 2)
+    if not len(boxes):
+      return moves
+
+    # fetch the solidity of every cell any of the sweeps can cross
+    x_lower = naturalize(numpy.floor((boxes[:, 0] + numpy.minimum(moves[:, 0], 0)).min()/TILE_DIMENSION))
+    x_upper = naturalize(numpy.ceil((boxes[:, 2] + numpy.maximum(moves[:, 0], 0)).max()/TILE_DIMENSION))
+    y_lower = naturalize(numpy.floor((boxes[:, 1] + numpy.minimum(moves[:, 1], 0)).min()/TILE_DIMENSION))
+    y_upper = naturalize(numpy.ceil((boxes[:, 3] + numpy.maximum(moves[:, 1], 0)).max()/TILE_DIMENSION))
+    solid = self.solid_in(x_lower, x_upper, y_lower, y_upper)
+
+    moves[:, 0] = sweep_axis(solid.T, boxes[:, 0] - x_lower*TILE_DIMENSION, boxes[:, 2] - x_lower*TILE_DIMENSION,
+                             boxes[:, 1] - y_lower*TILE_DIMENSION, boxes[:, 3] - y_lower*TILE_DIMENSION, moves[:, 0])
+    moves[:, 1] = sweep_axis(solid, boxes[:, 1] - y_lower*TILE_DIMENSION, boxes[:, 3] - y_lower*TILE_DIMENSION,
+                             boxes[:, 0] + moves[:, 0] - x_lower*TILE_DIMENSION,
+                             boxes[:, 2] + moves[:, 0] - x_lower*TILE_DIMENSION, moves[:, 1])
+    return moves
+
   # draw_visible_level:
   # Given dimensions/location of a camera, select subset of
   # tiles which belong on screen and draw them.
@@ -72,16 +420,268 @@ class Level():
   # index bounds of the subset
   # NOTE: this method should be generalized to return
   #       a subset of tiles within a radius of an object
+  # Tiles are drawn from pre-rendered BAKED_CHUNK_DIMENSION-sized
+  # surfaces, so this only takes a handful of large blits
   def draw_visible_level(self, cam_top_left_corner, cam_bot_right_corner):
-    x_lower_bound = naturalize(cam_top_left_corner[0]/TILE_DIMENSION)
-    x_upper_bound = naturalize(cam_bot_right_corner[0]/TILE_DIMENSION + 1)
-    y_lower_bound = naturalize(cam_top_left_corner[1]/TILE_DIMENSION)
-    y_upper_bound = naturalize(cam_bot_right_corner[1]/TILE_DIMENSION + 1)
-    #print("{0} {1} {2} {3}".format(x_lower_bound, x_upper_bound, y_lower_bound, y_upper_bound))
-    for row in self.tiles[y_lower_bound:y_upper_bound]:
-      for tile in row[x_lower_bound:x_upper_bound]:
-        tile.draw_tile(cam_top_left_corner[0], cam_top_left_corner[1])
+    x_lower_bound, x_upper_bound, y_lower_bound, y_upper_bound = self.index_bounds(cam_top_left_corner, cam_bot_right_corner)
+    x_upper_bound, y_upper_bound = min(x_upper_bound, self.width), min(y_upper_bound, self.height)
+    # blit positions get truncated, so round the offset the same way
+    # that drawing every tile at (real position - offset) would
+    xoffset = int(math.ceil(cam_top_left_corner[0]))
+    yoffset = int(math.ceil(cam_top_left_corner[1]))
+
+    dim = BAKED_CHUNK_DIMENSION
+    for by in range(y_lower_bound // dim, (y_upper_bound - 1) // dim + 1):
+      for bx in range(x_lower_bound // dim, (x_upper_bound - 1) // dim + 1):
+        # only blit the part of the chunk inside the bounds
+        x0, x1 = max(x_lower_bound, bx*dim), min(x_upper_bound, (bx + 1)*dim)
+        y0, y1 = max(y_lower_bound, by*dim), min(y_upper_bound, (by + 1)*dim)
+        area = pygame.Rect((x0 - bx*dim)*TILE_DIMENSION, (y0 - by*dim)*TILE_DIMENSION,
+                           (x1 - x0)*TILE_DIMENSION, (y1 - y0)*TILE_DIMENSION)
+        self.screen.blit(self.get_baked_chunk(bx, by),
+                         (x0*TILE_DIMENSION - xoffset, y0*TILE_DIMENSION - yoffset), area)
+
+  # get_baked_chunk:
+  # Return the surface with every tile of the given baked chunk drawn on
+  # it, rendering it if it isn't cached. Chunks with empty cells are
+  # transparent there
+  def get_baked_chunk(self, bx, by):
+    surface = self.baked_chunks.get((bx, by))
+    if surface is not None:
+      return surface
+
+    dim = BAKED_CHUNK_DIMENSION
+    codes = self.codes_in(bx*dim, (bx + 1)*dim, by*dim, (by + 1)*dim)
+    size = (dim*TILE_DIMENSION, dim*TILE_DIMENSION)
+    if codes.shape == (dim, dim) and not (codes == tile.EMPTY).any():
+      surface = pygame.Surface(size, 0, self.screen)
+    else:
+      surface = pygame.Surface(size, pygame.SRCALPHA)
+      surface.fill((0, 0, 0, 0))
+
+    type_images = [tile.images.get(name) for name in tile.type_names]
+    for y, row in enumerate(codes.tolist()):
+      for x, code in enumerate(row):
+        if code != tile.EMPTY:
+          surface.blit(type_images[code], (x*TILE_DIMENSION, y*TILE_DIMENSION))
+
+    self.baked_chunks.put((bx, by), surface, surface.get_width()*surface.get_height()*surface.get_bytesize())
+    return surface
+
+  # invalidate_tiles:
+  # Given [y][x] index bounds of tiles which have changed, throw away
+  # the pre-rendered surfaces containing them
+  def invalidate_tiles(self, x_lower, x_upper, y_lower, y_upper):
+    dim = BAKED_CHUNK_DIMENSION
+    for by in range(y_lower // dim, (y_upper - 1) // dim + 1):
+      for bx in range(x_lower // dim, (x_upper - 1) // dim + 1):
+        self.baked_chunks.discard((bx, by))
         
+  # line_of_sight:
+  # Given (N, 2) arrays of origins and targets in real coordinates (or
+  # a single point for either, shared by every pair), return an (N,)
+  # boolean array of whether each target can be seen from its origin,
+  # i.e. whether the segment between them crosses no opaque cell.
+  # Anything outside the map counts as opaque. Every segment is cut up
+  # where it crosses grid lines, and the cell under the middle of each
+  # piece is looked up, for all the segments at once
+  def line_of_sight(self, origins, targets):
+    origins, targets = numpy.broadcast_arrays(numpy.asarray(origins, dtype=float).reshape(-1, 2),
+                                              numpy.asarray(targets, dtype=float).reshape(-1, 2))
+    if not len(origins):
+      return numpy.zeros(0, dtype=bool)
+
+    # the opacity of every cell the segments could cross
+    lower = numpy.floor(numpy.minimum(origins, targets).min(axis=0)/TILE_DIMENSION).astype(int)
+    upper = numpy.floor(numpy.maximum(origins, targets).max(axis=0)/TILE_DIMENSION).astype(int) + 1
+    opaque = numpy.ones((upper[1] - lower[1], upper[0] - lower[0]), dtype=bool)
+    x_start, y_start = max(lower[0], 0), max(lower[1], 0)
+    inside = self.opaque_in(x_start, max(upper[0], x_start), y_start, max(upper[1], y_start))
+    opaque[y_start-lower[1]:y_start-lower[1]+inside.shape[0],
+           x_start-lower[0]:x_start-lower[0]+inside.shape[1]] = inside
+
+    # where, from 0 to 1 along each segment, it crosses a grid line.
+    # Rows are padded out with 1s
+    count = len(origins)
+    crossings = [numpy.zeros((count, 1)), numpy.ones((count, 1))]
+    for axis in (0, 1):
+      start, end = origins[:, axis]/TILE_DIMENSION, targets[:, axis]/TILE_DIMENSION
+      first = numpy.floor(numpy.minimum(start, end)) + 1
+      lines = numpy.ceil(numpy.maximum(start, end)) - first
+      steps = numpy.arange(max(int(lines.max()), 0))
+      with numpy.errstate(divide="ignore", invalid="ignore"):
+        along = (first[:, numpy.newaxis] + steps - start[:, numpy.newaxis])/(end - start)[:, numpy.newaxis]
+      along[steps >= lines[:, numpy.newaxis]] = 1.0
+      crossings.append(along)
+    crossings = numpy.sort(numpy.hstack(crossings), axis=1)
+
+    # pieces of no length (at corners, or padding) cross no cell
+    pieces = crossings[:, 1:] > crossings[:, :-1]
+    middles = (crossings[:, 1:] + crossings[:, :-1])/2.0
+    points = origins[:, numpy.newaxis] + (targets - origins)[:, numpy.newaxis]*middles[:, :, numpy.newaxis]
+    cells = numpy.floor(points/TILE_DIMENSION).astype(int) - lower
+    return ~(opaque[cells[:, :, 1], cells[:, :, 0]] & pieces).any(axis=1)
+
+  # get_occluder_snapshot:
+  # Return a read-only stand-in for the level which light geometry can
+  # be computed against on other threads or processes, see LightPool
+  def get_occluder_snapshot(self):
+    return OccluderSnapshot(self)
+
+class OccluderSnapshot(Level):
+
+  # OccluderSnapshot constructor:
+  # takes a Level, and keeps only what shadow geometry needs from it: the
+  # opacity grid and the occluder regions, as of the level's current
+  # version. There's no screen and no surfaces, so a snapshot can be
+  # pickled and sent to worker processes. set_tile() replaces regions
+  # rather than changing them, so only the type and opacity grids are
+  # copied. Later changes to the level are applied with apply_edits()
+  def __init__(self, level):
+    self.level_path = level.level_path
+    self.tile_dimension = level.tile_dimension
+    self.height, self.width = level.height, level.width
+    self.opaque_table = level.opaque_table
+    self.grid = level.grid.copy()
+    self.opaque = level.opaque.copy()
+    self.occluder_regions = dict(level.occluder_regions)
+    self.version = level.version
+    self.region_versions = dict(level.region_versions)
+    self.tile_edits = {}
+
+  def set_code(self, x, y, code):
+    old_code = self.grid[y, x]
+    self.grid[y, x] = code
+    self.opaque[y, x] = self.opaque_table[code]
+    return old_code
+
+  def invalidate_tiles(self, x_lower, x_upper, y_lower, y_upper):
+    pass
+
+# Given the file path for a level text file, return the path its
+# compiled version is kept at. The name holds a hash of the text, and of
+# everything else the compiled data depends on, so a changed level (or
+# tile set) never matches a stale compiled file
+def get_compiled_level_path(level_path):
+  level_file = open(level_path, "rb")
+  digest = hashlib.sha1(level_file.read())
+  level_file.close()
+  digest.update(repr((LEVEL_CACHE_VERSION, TILE_DIMENSION, OCCLUDER_BUCKET_DIMENSION,
+                      sorted(tile.char_to_type.items()),
+                      sorted([(name, sorted(attributes.items())) for name, attributes in tile.types.items()])
+                      )).encode("ascii"))
+  directory, name = os.path.split(os.path.abspath(level_path))
+  return os.path.join(directory, LEVEL_CACHE_DIR, "%s-%s.npz" % (name, digest.hexdigest()))
+
+# Given the file path for a level text file, return a 2D array
+# containing the type code of every tile, indexed [y][x]. Short
+# rows are padded with EMPTY
+def parse_level_file(level_path):
+  level_file = open(level_path)
+  lines = [line.strip() for line in level_file]
+  level_file.close()
+
+  char_codes = tile.get_code_table()
+  grid = numpy.empty((len(lines), max([len(line) for line in lines] + [0])), dtype=numpy.uint8)
+  grid[:] = tile.EMPTY
+  for y, line in enumerate(lines):
+    codes = parse_level_line(line, char_codes)
+    grid[y, :len(codes)] = codes
+  
+  return grid
+
+# Given a stripped line of a level text file and the table from
+# tile.get_code_table(), return the type codes of its tiles
+def parse_level_line(line, char_codes):
+  codes = char_codes[numpy.frombuffer(line.encode("ascii"), dtype=numpy.uint8)]
+  if (codes == tile.EMPTY).any():
+    raise KeyError(line[numpy.nonzero(codes == tile.EMPTY)[0][0]])
+  return codes
+
+# Collapse the outline of the opaque cells of a grid into merged edge
+# segments. opaque is indexed [y][x], and includes a one cell border
+# around the cells whose edges are wanted; (x_index, y_index) is the
+# level index of the first cell inside that border. Edges shared by two
+# opaque cells are dropped, and runs of adjacent exposed edges become
+# one segment. Given split, runs are also broken wherever a level index
+# is a multiple of it. Returns an (E, 4) array of [x1, y1, x2, y2]
+# segments in real coordinates, along with an (E, 2) array of their
+# outward normals
+def merged_edges(opaque, x_index, y_index, split=None):
+  inner = opaque[1:-1, 1:-1]
+
+  edges, normals = [], []
+  # horizontal edges: runs along each row of tiles
+  for exposed, y_offset, normal in ((inner & ~opaque[:-2, 1:-1], 0, (0, -1)),
+                                    (inner & ~opaque[2:, 1:-1], 1, (0, 1))):
+    for row, start, end in exposed_runs(exposed, x_index, split):
+      y = (row + y_index + y_offset) * TILE_DIMENSION
+      edges.append(((start + x_index) * TILE_DIMENSION, y, (end + x_index) * TILE_DIMENSION, y))
+      normals.append(normal)
+  # vertical edges: runs along each column of tiles
+  for exposed, x_offset, normal in ((inner & ~opaque[1:-1, :-2], 0, (-1, 0)),
+                                    (inner & ~opaque[1:-1, 2:], 1, (1, 0))):
+    for col, start, end in exposed_runs(exposed.T, y_index, split):
+      x = (col + x_index + x_offset) * TILE_DIMENSION
+      edges.append((x, (start + y_index) * TILE_DIMENSION, x, (end + y_index) * TILE_DIMENSION))
+      normals.append(normal)
+
+  return (numpy.array(edges, dtype=float).reshape(-1, 4),
+          numpy.array(normals, dtype=float).reshape(-1, 2))
+
+# Given a 2D boolean array, return a list of (row, start, end) for every
+# run of consecutive True values along its rows, end being exclusive.
+# Given split, runs are also broken before every column whose index plus
+# offset is a multiple of it
+def exposed_runs(exposed, offset=0, split=None):
+  padded = numpy.zeros((exposed.shape[0], exposed.shape[1] + 2), dtype=numpy.int8)
+  padded[:, 1:-1] = exposed
+  steps = numpy.diff(padded, axis=1)
+  starting = steps[:, :-1] == 1 # runs starting at each column
+  ending = steps[:, 1:] == -1   # runs ending after each column
+  if split is not None:
+    boundaries = numpy.nonzero((numpy.arange(1, exposed.shape[1]) + offset) % split == 0)[0] + 1
+    starting[:, boundaries] |= exposed[:, boundaries]
+    ending[:, boundaries - 1] |= exposed[:, boundaries - 1]
+  rows, starts = numpy.nonzero(starting)
+  ends = numpy.nonzero(ending)[1] + 1
+  return zip(rows.tolist(), starts.tolist(), ends.tolist())
+
+# Sweep boxes along one axis of a boolean grid of solid cells, indexed
+# [along][across]. Given arrays of each box's half-open extent along the
+# axis (lower, upper) and across it (across_lower, across_upper), in real
+# coordinates relative to the grid's first cell, and of how far each one
+# wants to move, return how far each can move before the first solid
+# cell it would newly enter. Cells outside the grid are open
+def sweep_axis(solid, lower, upper, across_lower, across_upper, delta):
+  forward = delta > 0
+  # the range of cells along the axis each box newly enters, walked away
+  # from the box, and the range of cells across the axis it covers
+  first = numpy.where(forward, numpy.ceil(upper/TILE_DIMENSION), numpy.floor(lower/TILE_DIMENSION) - 1).astype(int)
+  last = numpy.where(forward, numpy.ceil((upper + delta)/TILE_DIMENSION) - 1,
+                     numpy.floor((lower + delta)/TILE_DIMENSION)).astype(int)
+  step = numpy.where(forward, 1, -1)
+  counts = numpy.where(delta != 0, (last - first)*step + 1, 0)
+  across_first = numpy.floor(across_lower/TILE_DIMENSION).astype(int)
+  across_counts = numpy.ceil(across_upper/TILE_DIMENSION).astype(int) - across_first
+  if not solid.size or counts.max() <= 0 or across_counts.max() <= 0:
+    return delta
+
+  cells = first[:, numpy.newaxis] + step[:, numpy.newaxis]*numpy.arange(counts.max())
+  across = across_first[:, numpy.newaxis] + numpy.arange(across_counts.max())
+  valid = ((numpy.arange(cells.shape[1]) < counts[:, numpy.newaxis]) &
+           (cells >= 0) & (cells < solid.shape[0]))[:, :, numpy.newaxis]
+  valid = valid & ((numpy.arange(across.shape[1]) < across_counts[:, numpy.newaxis]) &
+                   (across >= 0) & (across < solid.shape[1]))[:, numpy.newaxis, :]
+  hits = solid[numpy.clip(cells, 0, solid.shape[0] - 1)[:, :, numpy.newaxis],
+               numpy.clip(across, 0, solid.shape[1] - 1)[:, numpy.newaxis, :]]
+  hits = (hits & valid).any(axis=2)
+
+  blocked = hits.any(axis=1)
+  stop_cells = cells[numpy.arange(len(cells)), numpy.argmax(hits, axis=1)]
+  stops = numpy.where(forward, stop_cells*TILE_DIMENSION - upper, (stop_cells + 1)*TILE_DIMENSION - lower)
+  return numpy.where(blocked, stops, delta)
+
 # Naturalizes a number. Duh.
 def naturalize(num):
   if num > 0:
@@ -1,6 +1,8 @@
-import pygame, math
+import pygame, math, numpy
 from pygame.sprite import Sprite
 from pymunk.vec2d import Vec2d
+from cache import LRUCache
+from profiler import frame_profiler
 
 class Light():
   HEIGHT = 100.5                # the height lights are held from the ground
@@ -12,27 +14,64 @@ class Light():
   MIN_LENGTH = 60.0
   MAX_LENGTH = 600.0
 
-  def __init__(self, color, emitter_pos, projection_pos, direction, aperture_angle):
+  # falloff shapes: map the normalized distance from the center of the
+  # light surface (an array of values in [0, 1]) to a scaling coefficient
+  # in [0, 1], where 0 is full brightness and 1 is no light at all
+  FALLOFFS = { "linear": lambda dist: dist,
+               "quadratic": lambda dist: dist**2,
+               "smooth": lambda dist: dist*dist*(3 - 2*dist) }
+
+  # process-wide registry of base mask surfaces, keyed by
+  # (falloff, color, preset size)
+  mask_registry = {}
+
+  # scaled and rotated light surfaces are cached process-wide, keyed by
+  # (falloff, color, width, length, direction) after quantization, within
+  # SURFACE_MEMORY_BUDGET bytes. Larger steps trade fidelity for a higher
+  # hit rate
+  SURFACE_MEMORY_BUDGET = 32 * 2**20
+  SIZE_QUANTIZATION_STEP = 1      # pixels
+  ANGLE_QUANTIZATION_STEP = 1.0   # degrees
+  surface_cache = LRUCache(SURFACE_MEMORY_BUDGET)
+
+  # shadow casting strategies:
+  #   tiles: one polygon per opaque tile in the projection area
+  #   edges: one polygon per merged occluder edge of the level
+  #   visibility: a single polygon covering everything the emitter can't see
+  SHADOW_MODES = ("tiles", "edges", "visibility")
+  SWEEP_EPSILON = 1e-7 # radians; how far either side of an event the sweep looks
+
+  # headless runs keep the shadow geometry of every light, but never draw
+  # them, so they only size the light surfaces rather than making them
+  BUILD_SURFACES = True
+
+  def __init__(self, color, emitter_pos, projection_pos, direction, aperture_angle, falloff="linear", shadow_mode="edges"):
     self.emitter_pos = Vec2d(emitter_pos) # position of the emitter (flashlight)
     self.proj_pos = Vec2d(projection_pos) # center of the light ellipse
     self.direction = direction            # init direction of light
     self.aperture_angle = aperture_angle  # angle of light cone
     self.deflection_angle = self.get_deflection_angle()
     
-    # for the light surfaces, begin with a preset size, create the mask,
-    # and then scale from there
-    self.base_alpha_surface = pygame.Surface((self.PRESET_SURFACE_WIDTH, self.PRESET_SURFACE_LENGTH), pygame.SRCALPHA)
-    self.alpha_surface = pygame.Surface((self.PRESET_SURFACE_WIDTH, self.PRESET_SURFACE_LENGTH), pygame.SRCALPHA)
-    self.set_alpha_surface_mask()
+    self.falloff = falloff                # name of the gradient shape, see FALLOFFS
+    self.shadow_mode = shadow_mode        # one of SHADOW_MODES
+    self.color = tuple(color)
 
-    self.base_color_surface = pygame.Surface((self.PRESET_SURFACE_WIDTH, self.PRESET_SURFACE_LENGTH), pygame.SRCALPHA)
-    self.color_surface = pygame.Surface((self.PRESET_SURFACE_WIDTH, self.PRESET_SURFACE_LENGTH), pygame.SRCALPHA)
-    self.set_color_surface_mask(color)
+    # for the light surfaces, begin with a preset size, create the mask,
+    # and then scale from there. Base masks are shared between all lights
+    # with the same falloff/color, so they must never be drawn onto
+    self.base_alpha_surface, self.base_color_surface = Light.get_base_surfaces(falloff, self.color)
+    self.alpha_surface = self.base_alpha_surface
+    self.color_surface = self.base_color_surface
+    self.surface_size = self.alpha_surface.get_size() # size of the rotated light surface
     
     self.l_width, self.l_length = 100,100
     
     #initialize the list of shadow polygons
     self.polylist = []
+    self.visibility_polygon = [] # only maintained in "visibility" mode
+
+    # (emitter, projection, level) as of the last update_surface call
+    self.last_state = None
     
     
     
@@ -78,160 +117,488 @@ class Light():
     
     return deflection
   
-  # get_polygon_list: given a list of opaque shadows, paint the appropriate 
-  # shadows on the surfaces
+  # get_polygon_list: given the level, return the list of shadow
+  # polygons cast by its opaque tiles, using this light's shadow mode
   def get_polygon_list(self, level):
-    tiles = self.get_opaque_tiles(level)
+    if self.shadow_mode == "edges":
+      return self.get_edge_polygon_list(level)
+    if self.shadow_mode == "visibility":
+      return self.get_visibility_polygon_list(level)
 
-    pointlist = []
-    for tile in tiles:
-      pointlist.append(self.get_shadow_points(tile))
-      
-    return pointlist 
+    positions, tile_dim = self.get_opaque_tile_positions(level)
+    corners = self.get_tile_corners(positions, tile_dim)
+    return self.get_shadow_polygons(corners).tolist()
   
-  # get_opaque_tiles: return a list of Tiles which are in the 
-  # projection area, and which light does not go through
-  def get_opaque_tiles(self, level):
-    realwidth = self.alpha_surface.get_rect().width
-    realheight = self.alpha_surface.get_rect().height
+  # get_projection_bounds: return the top left and bottom right corners
+  # of the (rotated) light surface, centered on the projection position.
+  # Given a surface size, return those of a surface that size instead
+  def get_projection_bounds(self, surface_size=None):
+    realwidth, realheight = surface_size or self.surface_size
     right_edge_pos = self.proj_pos.x + realwidth/2
     bot_edge_pos = self.proj_pos.y + realheight/2
     offset_pos = (self.proj_pos[0] - realwidth/2, self.proj_pos[1] - realheight/2)
     
+    return (offset_pos, (right_edge_pos, bot_edge_pos))
+
+  # get_target_bounds: return the corners get_projection_bounds() will
+  # have once the light is updated to its current emitter and projection
+  # positions, which may have moved since its last update
+  def get_target_bounds(self):
+    return self.get_projection_bounds(self.get_transformed_size(dimensions=self.get_target_dimensions()))
+
+  # get_opaque_tiles: return a list of Tiles which are in the 
+  # projection area, and which light does not go through
+  def get_opaque_tiles(self, level):
     # set corners for tiles_at()
-    proj_top_left = offset_pos
-    proj_bot_right = (right_edge_pos, bot_edge_pos)
+    proj_top_left, proj_bot_right = self.get_projection_bounds()
     
     tiles_in_projection_area = level.tiles_at(proj_top_left, proj_bot_right)
     opaque_tiles = [tile for tile in tiles_in_projection_area if not tile.attributes["shinethrough"]]
     
     return opaque_tiles
   
+  # get_opaque_tile_positions: the array version of get_opaque_tiles.
+  # Return an (N, 2) array of the real positions of the opaque tiles
+  # in the projection area, along with the tile dimension
+  def get_opaque_tile_positions(self, level):
+    proj_top_left, proj_bot_right = self.get_projection_bounds()
+    opacity, (x_index, y_index) = level.opacity_at(proj_top_left, proj_bot_right)
+    ys, xs = numpy.nonzero(opacity)
+    tile_dim = level.tile_dimension
+    
+    return numpy.column_stack((xs + x_index, ys + y_index)) * tile_dim, tile_dim
+
+  # get_edge_polygon_list: return one shadow polygon per merged occluder
+  # edge of the level which faces the emitter and touches the projection
+  # area. Edges are clipped to the projection area first, so that every
+  # polygon stays local to the light
+  def get_edge_polygon_list(self, level):
+    (left, top), (right, bot) = self.get_projection_bounds()
+    edges, normals = level.occluders_at((left, top), (right, bot))
+    ex, ey = self.emitter_pos.x, self.emitter_pos.y
+
+    # the far side of each shadow must lie beyond everything the light
+    # can reach. A wedge narrower than 180 degrees, closed off with a
+    # vertex along its bisector, stays at least cos(45) of the trace
+    # distance away from the emitter, so overshoot by a safe margin
+    reach = max(math.hypot(x - ex, y - ey) for x in (left, right) for y in (top, bot))
+    trace_dist = 1.5 * reach + 1
+
+    # only edges facing the emitter cast a shadow
+    facing = (ex - edges[:, 0])*normals[:, 0] + (ey - edges[:, 1])*normals[:, 1] > 0
+    edges = edges[facing]
+    edges[:, 0::2] = numpy.clip(edges[:, 0::2], left, right)
+    edges[:, 1::2] = numpy.clip(edges[:, 1::2], top, bot)
+    ends = edges.reshape(-1, 2, 2)
+
+    # unit directions from the emitter through both ends of each edge
+    emitter = numpy.array([ex, ey])
+    rays = ends - emitter
+    lengths = numpy.sqrt((rays**2).sum(axis=2))
+    ends, rays, lengths = [a[(lengths > 0).all(axis=1)] for a in (ends, rays, lengths)]
+    rays /= lengths[:, :, numpy.newaxis]
+    bisectors = rays.sum(axis=1)
+    bisectors /= numpy.sqrt((bisectors**2).sum(axis=1))[:, numpy.newaxis]
+
+    polygons = numpy.empty((len(ends), 5, 2))
+    polygons[:, 0:2] = ends
+    polygons[:, 2] = emitter + rays[:, 1]*trace_dist
+    polygons[:, 3] = emitter + bisectors*trace_dist
+    polygons[:, 4] = emitter + rays[:, 0]*trace_dist
+
+    return polygons.tolist()
+
+  # get_visibility_polygon_list: compute the polygon of everything the
+  # emitter can see, and return the darkness around it as a single
+  # polygon, so that it can be masked with one fill
+  def get_visibility_polygon_list(self, level):
+    (left, top), (right, bot) = self.get_projection_bounds()
+    ex, ey = self.emitter_pos.x, self.emitter_pos.y
+
+    # the sweep needs a closed boundary around the emitter, which
+    # isn't necessarily inside its own projection
+    left, top = min(left, ex) - 1, min(top, ey) - 1
+    right, bot = max(right, ex) + 1, max(bot, ey) + 1
+
+    # only edges facing the emitter can be the closest thing to it
+    edges, normals = level.occluders_at((left, top), (right, bot))
+    facing = (ex - edges[:, 0])*normals[:, 0] + (ey - edges[:, 1])*normals[:, 1] > 0
+    edges = edges[facing]
+    edges[:, 0::2] = numpy.clip(edges[:, 0::2], left, right)
+    edges[:, 1::2] = numpy.clip(edges[:, 1::2], top, bot)
+    boundary = numpy.array([[left, top, right, top], [right, top, right, bot],
+                            [right, bot, left, bot], [left, bot, left, top]], dtype=float)
+
+    origin = numpy.array([ex, ey, ex, ey])
+    polygon = self.angular_sweep(numpy.vstack((edges, boundary)) - origin)
+    self.visibility_polygon = [(x + ex, y + ey) for x, y in polygon]
+    if len(self.visibility_polygon) < 3:
+      return []
+
+    return [self.get_keyhole_polygon(self.visibility_polygon, (left, top, right, bot))]
+
+  # get_keyhole_polygon: given a polygon visible from the emitter and a
+  # (left, top, right, bottom) box around it, return one polygon which
+  # fills the box except for the visible polygon. The two are joined by
+  # a bridge along the ray from the emitter through the first vertex,
+  # which lies outside the visible polygon, and cancels out when filled
+  def get_keyhole_polygon(self, polygon, box):
+    left, top, right, bot = box
+    ex, ey = self.emitter_pos.x, self.emitter_pos.y
+    vx, vy = polygon[0]
+    dx, dy = vx - ex, vy - ey
+
+    # find where the ray leaves the box, and which side it leaves by
+    exits = []
+    if dx > 0: exits.append(((right - ex)/dx, 2)) # corners after the right side
+    if dx < 0: exits.append(((left - ex)/dx, 0))
+    if dy > 0: exits.append(((bot - ey)/dy, 3))
+    if dy < 0: exits.append(((top - ey)/dy, 1))
+    t, first_corner = min(exits)
+    bridge = (ex + dx*t, ey + dy*t)
+
+    corners = [(left, top), (right, top), (right, bot), (left, bot)]
+    ring = corners[first_corner:] + corners[:first_corner]
+    return [bridge] + ring + [bridge] + list(polygon) + [polygon[0]]
+
+  # angular_sweep: given an (S, 4) array of non-crossing [x1, y1, x2, y2]
+  # segments relative to the emitter, which enclose it, return the
+  # vertices of the visibility polygon in order of angle. Segment
+  # endpoints are sorted by angle and swept once, keeping the segments
+  # the sweeping ray currently crosses ordered from nearest to farthest.
+  # Non-crossing segments never swap places while both are crossed, so
+  # each is put in place with a binary search when the sweep reaches it.
+  # That's O(E log E) for sorting the E events, plus O(log A) comparisons
+  # and an O(A) list shift per event, where A is the most segments one
+  # ray crosses: a handful in a level, against hundreds of segments
+  @classmethod
+  def angular_sweep(cls, segments):
+    angles_1 = numpy.arctan2(segments[:, 1], segments[:, 0])
+    angles_2 = numpy.arctan2(segments[:, 3], segments[:, 2])
+    span = (angles_2 - angles_1 + math.pi) % (2*math.pi) - math.pi
+
+    # drop segments which are edge-on to the emitter, and orient the rest
+    # so that they're swept from their first endpoint to their second
+    keep = numpy.abs(span) > cls.SWEEP_EPSILON
+    flip = span[keep] < 0
+    segments = segments[keep]
+    segments[flip] = segments[flip][:, [2, 3, 0, 1]]
+    starts = numpy.where(flip, angles_2[keep], angles_1[keep]).tolist()
+    ends = numpy.where(flip, angles_1[keep], angles_2[keep]).tolist()
+    segments = segments.tolist()
+
+    def distance(index, angle):
+      dx, dy = math.cos(angle), math.sin(angle)
+      px, py, qx, qy = segments[index]
+      qx, qy = qx - px, qy - py
+      return (px*qy - py*qx)/(dx*qy - dy*qx)
+
+    def hit(index, angle):
+      dist = distance(index, angle)
+      return (math.cos(angle)*dist, math.sin(angle)*dist)
+
+    # put a segment whose sweep begins at angle in its place in order,
+    # comparing it with others halfway through the angles both cover
+    order = []
+    def insert(index, angle):
+      reach = (ends[index] - angle) % (2*math.pi)
+      lower, upper = 0, len(order)
+      while lower < upper:
+        middle = (lower + upper)//2
+        other = order[middle]
+        probe = angle + min(reach, (ends[other] - angle) % (2*math.pi))/2
+        if distance(index, probe) < distance(other, probe):
+          upper = middle
+        else:
+          lower = middle + 1
+      order.insert(lower, index)
+
+    # segments crossing the -pi/pi cut are already under the ray at the
+    # start of the sweep
+    for index in range(len(segments)):
+      if starts[index] > ends[index]:
+        insert(index, -math.pi)
+    events = sorted([(angle, 0, i) for i, angle in enumerate(ends)] +
+                    [(angle, 1, i) for i, angle in enumerate(starts)])
+
+    polygon = []
+    i = 0
+    while i < len(events):
+      angle = events[i][0]
+      before = order[0] if order else None
+      group = i
+      while i < len(events) and events[i][0] - angle < cls.SWEEP_EPSILON:
+        i += 1
+      # segments which end here leave before those which start here are
+      # placed, so they're never compared with ones they don't overlap
+      for event_angle, starting, index in events[group:i]:
+        if not starting:
+          order.remove(index)
+      for event_angle, starting, index in events[group:i]:
+        if starting:
+          insert(index, event_angle)
+      after = order[0] if order else None
+      if before != after:
+        if before is not None:
+          polygon.append(hit(before, angle))
+        if after is not None:
+          polygon.append(hit(after, angle))
+
+    return polygon
+
   # trace_point: given the location of the emitter, as well as 
   # another point and a distance, return the point on the line 
-  # formed by the emitter position and p2, which is dist away from the emitter
+  # formed by the emitter position and p2, which is dist away from p2
   def trace_point(self, p2, dist):
-    x1, y1 = self.emitter_pos.x, self.emitter_pos.y
-    x2, y2 = p2.x, p2.y
-    theta = math.atan2((y2-y1),(x2-x1))    
-    if theta<0:
-      d= (180*(theta+(math.pi*2))/math.pi)
-    else:
-      d= (180*(theta)/math.pi)
-    dx = math.cos(math.radians(d))
-    dy = math.sin(math.radians(d))                
-    
-    return (x2 + dx*dist, y2 + dy*dist)
+    return tuple(self.trace_points(numpy.array([p2.x, p2.y], dtype=float), dist))
+
+  # trace_points: the batched version of trace_point, for an array of
+  # points whose last axis holds (x, y). The projection is just the unit
+  # direction from the emitter, scaled by dist
+  def trace_points(self, points, dist):
+    rays = points - numpy.array([self.emitter_pos.x, self.emitter_pos.y])
+    lengths = numpy.sqrt((rays**2).sum(axis=-1))[..., numpy.newaxis]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+      units = numpy.where(lengths > 0, rays/lengths, 0.0)
+    return points + units*dist
+
+  # get_tile_corners: given a sequence of (x, y) tile positions, return
+  # an (N, 4, 2) array of the tiles' corners, in the same order as
+  # Tile.corners (top left, top right, bottom left, bottom right)
+  @staticmethod
+  def get_tile_corners(positions, tile_dim):
+    offsets = numpy.array([(0, 0), (1, 0), (0, 1), (1, 1)], dtype=float) * tile_dim
+    positions = numpy.asarray(positions, dtype=float).reshape(-1, 1, 2)
+    return positions + offsets
 
   # get_shadow_points: given a tile, return a list of points which 
   # forms the polygon that represents the shadow formed by shining 
   # the light from the emitter position onto the tile
   def get_shadow_points(self, tile):
-    # define light->tile directions in terms of coordinates, which 
-    # follow this convention:
-    #  nw: (-1, 1)  | n: (0, 1)  | ne: (1, 1)
-    #   w: (0, -1)  |  TILE POS  |  e: (0, 1)
-    #  sw: (-1, -1) | s: (0, -1) | se: (-1, 1)
-    southwest, west, northwest, south, center, north, southeast, east, northeast = [(ew, ns) for ew in (-1, 0, 1) for ns in (-1, 0, 1)] 
-    dir_to_tile = tile.direction_from(self)
-
-    # get the 'real' dimensions of the rotated light surface
-    rot_height = self.alpha_surface.get_rect().height
-    rot_width = self.alpha_surface.get_rect().width
-
-    # grab the biggest dimension, as it will be used as the
-    # far edge of the shadow polygon
-    if rot_height > rot_width:
-      trace_to_dim = rot_height
-    else:
-      trace_to_dim = rot_width
-    
-    # based on the direction from light->til, store points for
+    corners = numpy.array([[(c.x, c.y) for c in tile.corners]], dtype=float)
+    polygons = self.get_shadow_polygons(corners).tolist()
+    return [tuple(p) for p in polygons[0]] if polygons else []
+
+  # shadow vertex table: for each light->tile direction, indexed by
+  # (ew+1)*3 + (ns+1) (see Tile.direction_from), the vertices of the
+  # shadow polygon as indices into [tl, tr, bl, br] followed by the
+  # same four corners traced away from the emitter. Polygons with only
+  # four distinct vertices repeat their last one. A light inside the
+  # tile (the center) casts no shadow
+  SHADOW_VERTICES = numpy.array([[4, 7, 3, 2, 0],   # southwest
+                                 [4, 6, 2, 0, 0],   # west
+                                 [5, 6, 2, 0, 1],   # northwest
+                                 [6, 7, 3, 2, 2],   # south
+                                 [0, 0, 0, 0, 0],   # center
+                                 [4, 5, 1, 0, 0],   # north
+                                 [5, 6, 2, 3, 1],   # southeast
+                                 [5, 7, 3, 1, 1],   # east
+                                 [4, 7, 3, 1, 0]])  # northeast
+
+  # get_shadow_polygons: the batched version of get_shadow_points. Given
+  # an (N, 4, 2) array of tile corners, return an (M, 5, 2) array with the
+  # shadow polygon of every tile that the emitter isn't inside of
+  def get_shadow_polygons(self, corners):
+    ex, ey = self.emitter_pos.x, self.emitter_pos.y
+    ew = numpy.where(ex < corners[:, 0, 0], -1, numpy.where(ex > corners[:, 3, 0], 1, 0))
+    ns = numpy.where(ey > corners[:, 3, 1], -1, numpy.where(ey < corners[:, 0, 1], 1, 0))
+    direction = (ew + 1)*3 + (ns + 1)
+    outside = direction != 4
+    corners, direction = corners[outside], direction[outside]
+
+    # get the 'real' dimensions of the rotated light surface, and
+    # grab the biggest one, as it will be used as the far edge of
     # the shadow polygon
-    pointlist = []
-    if dir_to_tile == north:
-      pointlist.append(self.trace_point(tile.topleft, trace_to_dim))
-      pointlist.append(self.trace_point(tile.topright, trace_to_dim))
-      pointlist= pointlist + [(tile.topleft.x, tile.topleft.y), (tile.topright.x,tile.topright.y)][::-1]
-    if dir_to_tile == south:
-      pointlist.append(self.trace_point(tile.botleft, trace_to_dim))
-      pointlist.append(self.trace_point(tile.botright, trace_to_dim))
-      pointlist = pointlist + [(tile.botleft.x, tile.botleft.y), (tile.botright.x, tile.botright.y)][::-1]
-    if dir_to_tile == east:
-      pointlist.append(self.trace_point(tile.topright, trace_to_dim))
-      pointlist.append(self.trace_point(tile.botright, trace_to_dim))
-      pointlist = pointlist + [(tile.topright.x, tile.topright.y), (tile.botright.x, tile.botright.y)][::-1]
-    if dir_to_tile == west:
-      pointlist.append(self.trace_point(tile.topleft, trace_to_dim))
-      pointlist.append(self.trace_point(tile.botleft, trace_to_dim))
-      pointlist = pointlist + [(tile.topleft.x, tile.topleft.y), (tile.botleft.x, tile.botleft.y)][::-1]
-    if dir_to_tile == northeast:
-      pointlist.append(self.trace_point(tile.topleft, trace_to_dim))
-      pointlist.append(self.trace_point(tile.botright, trace_to_dim))
-      pointlist = pointlist + [(tile.topleft.x, tile.topleft.y), (tile.topright.x, tile.topright.y), (tile.botright.x, tile.botright.y)][::-1]
-    if dir_to_tile == northwest:
-      pointlist.append(self.trace_point(tile.topright, trace_to_dim))
-      pointlist.append(self.trace_point(tile.botleft, trace_to_dim))
-      pointlist = pointlist + [(tile.topright.x, tile.topright.y), (tile.topleft.x, tile.topleft.y), (tile.botleft.x, tile.botleft.y)][::-1]
-    if dir_to_tile == southeast:
-      pointlist.append(self.trace_point(tile.topright, trace_to_dim))
-      pointlist.append(self.trace_point(tile.botleft, trace_to_dim))
-      pointlist = pointlist + [(tile.topright.x, tile.topright.y), (tile.botright.x, tile.botright.y), (tile.botleft.x, tile.botleft.y)][::-1]
-    if dir_to_tile == southwest:
-      pointlist.append(self.trace_point(tile.topleft, trace_to_dim))
-      pointlist.append(self.trace_point(tile.botright, trace_to_dim))
-      pointlist = pointlist + [(tile.topleft.x, tile.topleft.y), (tile.botleft.x, tile.botleft.y), (tile.botright.x, tile.botright.y)][::-1]
-    
-    return pointlist
+    trace_to_dim = max(self.surface_size)
+
+    points = numpy.concatenate((corners, self.trace_points(corners, trace_to_dim)), axis=1)
+    vertices = self.SHADOW_VERTICES[direction]
+    return points[numpy.arange(len(points))[:, numpy.newaxis], vertices]
+
+  # get_base_surfaces: return the (alpha, color) base mask surfaces for the
+  # given falloff and color, building them on first use. Lights with
+  # identical parameters share the same pair of surfaces
+  @classmethod
+  def get_base_surfaces(cls, falloff, color):
+    size = (cls.PRESET_SURFACE_WIDTH, cls.PRESET_SURFACE_LENGTH)
+    key = (falloff, tuple(color), size)
+    if key not in cls.mask_registry:
+      coeffs = cls.channel_scaling_coeffs(falloff)
+      alpha_surface = pygame.Surface(size, pygame.SRCALPHA)
+      cls.set_alpha_surface_mask(alpha_surface, coeffs)
+      color_surface = pygame.Surface(size, pygame.SRCALPHA)
+      cls.set_color_surface_mask(color_surface, color, coeffs)
+      cls.mask_registry[key] = (alpha_surface, color_surface)
+    return cls.mask_registry[key]
   
-  # channel_scaling_coeff: maps (x, y) pairs to values from [0, 1] 
-  # for use in making  gradient masks. Presently just uses the linear
-  # distance from the center of the surface
-  def channel_scaling_coeff(self, x, y):
-    center = self.PRESET_SURFACE_WIDTH/2
-    coeff = math.sqrt((x-center)**2 + (y-center)**2)/center
-    if(coeff > 1):
-      coeff = 1
-    return coeff
+  # channel_scaling_coeffs: return an array, indexed [x][y] like the
+  # surfarray views, which maps each pixel of the preset surface to a
+  # value from [0, 1] for use in making gradient masks. The falloff
+  # is applied to the linear distance from the center of the surface
+  @classmethod
+  def channel_scaling_coeffs(cls, falloff):
+    x_center = cls.PRESET_SURFACE_WIDTH/2.0
+    y_center = cls.PRESET_SURFACE_LENGTH/2.0
+    xs, ys = numpy.indices((cls.PRESET_SURFACE_WIDTH, cls.PRESET_SURFACE_LENGTH))
+    dist = numpy.sqrt(((xs - x_center)/x_center)**2 + ((ys - y_center)/y_center)**2)
+    dist = numpy.minimum(dist, 1.0)
+    return numpy.clip(cls.FALLOFFS[falloff](dist), 0.0, 1.0)
   
   # set_alpha_surface_mask: initializes the alpha mask, which will
   # be subtracted from the alpha values of the top shadow layer
-  def set_alpha_surface_mask(self):
-    self.base_alpha_surface.fill((0,0,0))
-    mask = pygame.surfarray.pixels_alpha(self.base_alpha_surface)
-    size = self.PRESET_SURFACE_WIDTH
-    
-    for x in range(size):
-      for y in range(size):
-        mask[x][y] = 255 * (1 - self.channel_scaling_coeff(x, y))
+  @staticmethod
+  def set_alpha_surface_mask(surface, coeffs):
+    surface.fill((0,0,0))
+    mask = pygame.surfarray.pixels_alpha(surface)
+    mask[:] = (255 * (1 - coeffs)).astype(numpy.uint8)
+    del mask # unlock the surface
         
   # set_color_surface_mask: initializes the color mask, which will be
   # added to the top shadow layer after alpha has been subtracted
-  def set_color_surface_mask(self, color):
-    self.base_color_surface.fill(color)
-    mask = pygame.surfarray.pixels3d(self.base_color_surface)
-    size = self.PRESET_SURFACE_WIDTH
-    
-    for x in range(size):
-      for y in range(size):
-        coeff = self.channel_scaling_coeff(x, y)
-        mask[x][y] = [color[0] * (1-coeff), color[1] * (1-coeff), color[2] * (1-coeff)]
+  @staticmethod
+  def set_color_surface_mask(surface, color, coeffs):
+    surface.fill(color)
+    mask = pygame.surfarray.pixels3d(surface)
+    scale = (1 - coeffs)[:, :, numpy.newaxis]
+    mask[:] = (numpy.array(color[:3], dtype=numpy.float64) * scale).astype(numpy.uint8)
+    del mask # unlock the surface
         
   # update_surface: given the current light state, along with the current
-  # level, redraw the light shape 
+  # level, redraw the light shape. Lights whose emitter and projection
+  # haven't moved since the last call are left untouched
   def update_surface(self, level):
-    self.deflection_angle = self.get_deflection_angle()
-    self.l_width, self.l_length = self.get_projection_dimensions()
-    self.direction = -(self.proj_pos-self.emitter_pos ).get_angle_degrees() + 90.0
-    self.polylist = self.get_polygon_list(level)
-    
-    del self.alpha_surface
-    self.alpha_surface = pygame.Surface((self.l_width, self.l_length), pygame.SRCALPHA)
-    pygame.transform.scale(self.base_alpha_surface, (self.l_width, self.l_length), self.alpha_surface)
-    self.alpha_surface = pygame.transform.rotate(self.alpha_surface, self.direction)
+    job = self.begin_update(level)
+    if job is None:
+      return
+
+    with frame_profiler.stage("update_surface"):
+      with frame_profiler.stage("shadow_polygons"):
+        geometry = Light.get_shadow_geometry(job, level)
+      self.finish_update(job, geometry)
+
+  # begin_update: the first step of update_surface. Return a job holding
+  # everything the shadow geometry of the light's current state depends
+  # on, or None if the state hasn't changed. The job is plain data, so it
+  # can be handed to get_shadow_geometry() on another thread or process;
+  # the light itself isn't changed until finish_update(). Lights are
+  # also updated when a set_tile() call has changed the level around them
+  def begin_update(self, level):
+    # the shadows are cast in the bounds of the surface the new state
+    # will have, not the last one, or a light which has just grown
+    # would keep the shadows of its smaller box once it stops moving
+    width, length, direction = self.get_target_dimensions()
+    surface_size = self.get_transformed_size(dimensions=(width, length, direction))
+    (left, top), (right, bot) = self.get_projection_bounds(surface_size)
+    version = level.version_at((min(left, self.emitter_pos.x), min(top, self.emitter_pos.y)),
+                               (max(right, self.emitter_pos.x), max(bot, self.emitter_pos.y)))
+    state = (tuple(self.emitter_pos), tuple(self.proj_pos), level, version)
+    if state == self.last_state:
+      return None
+    self.last_state = state
 
-    del self.color_surface
-    self.color_surface = pygame.Surface((self.l_width, self.l_length), pygame.SRCALPHA)
-    pygame.transform.scale(self.base_color_surface, (self.l_width, self.l_length), self.color_surface)
-    self.color_surface = pygame.transform.rotate(self.color_surface, self.direction)
+    return { "shadow_mode": self.shadow_mode,
+             "emitter_pos": state[0],
+             "proj_pos": state[1],
+             "surface_size": surface_size,
+             "l_width": width,
+             "l_length": length,
+             "direction": direction }
+
+  # get_shadow_geometry: given a job from begin_update() and the level
+  # (or an occluder snapshot of it), return the (shadow polygons,
+  # visibility polygon) of the light state it describes
+  @classmethod
+  def get_shadow_geometry(cls, job, level):
+    light = cls((0,0,0), job["emitter_pos"], job["proj_pos"], 0.0, 0.0, shadow_mode=job["shadow_mode"])
+    light.surface_size = job["surface_size"]
+    polylist = light.get_polygon_list(level)
+    return polylist, light.visibility_polygon
+
+  # finish_update: the last step of update_surface. Given a job from
+  # begin_update() and its geometry, move the light into that state
+  def finish_update(self, job, geometry):
+    self.l_width, self.l_length = job["l_width"], job["l_length"]
+    self.direction = job["direction"]
+    self.polylist, self.visibility_polygon = geometry
     
+    self.surface_size = job["surface_size"]
+    if self.BUILD_SURFACES:
+      self.alpha_surface, self.color_surface = self.get_transformed_surfaces()
+
+  # invalidate: force the next update_surface call to recompute the
+  # light, e.g. after the level it shines on has changed
+  def invalidate(self):
+    self.last_state = None
+
+  # get_illumination: given an (N, 2) array of points in real coordinates
+  # and the level, return an (N,) array of how brightly the light shines
+  # on each, as of its last update: from 1 at the projection position,
+  # falling off like the light surface to 0 at the edge of the projection
+  # ellipse. Points the emitter has no line of sight to get 0
+  def get_illumination(self, points, level):
+    points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+    angle = math.radians(90.0 - self.direction)
+    along = numpy.array((math.cos(angle), math.sin(angle)))
+    across = numpy.array((-along[1], along[0]))
+    offsets = points - tuple(self.proj_pos)
+    dist = numpy.sqrt((offsets.dot(across)/(self.l_width/2.0))**2 +
+                      (offsets.dot(along)/(self.l_length/2.0))**2)
+    brightness = 1.0 - numpy.clip(self.FALLOFFS[self.falloff](numpy.minimum(dist, 1.0)), 0.0, 1.0)
+
+    shining = brightness > 0
+    brightness[shining] *= level.line_of_sight(tuple(self.emitter_pos), points[shining])
+    return brightness
+
+  # is_lit: given an (N, 2) array of points in real coordinates and the
+  # level, return an (N,) boolean array of whether the light shines on
+  # each brighter than threshold, see get_illumination()
+  def is_lit(self, points, level, threshold=0.0):
+    return self.get_illumination(points, level) > threshold
+
+  # get_target_dimensions: return the (width, length, direction) of the
+  # light's projection at its current emitter and projection positions,
+  # which the next update will scale and rotate its surfaces to
+  def get_target_dimensions(self):
+    self.deflection_angle = self.get_deflection_angle()
+    width, length = self.get_projection_dimensions()
+    return width, length, -(self.proj_pos-self.emitter_pos ).get_angle_degrees() + 90.0
+
+  # get_transform: return the (width, length, direction) the light
+  # surfaces are scaled and rotated to. Sizes and angle are quantized so
+  # that nearby states share one cache entry. A downsample factor
+  # shrinks the surfaces, for low resolution buffers. Given dimensions
+  # from get_target_dimensions(), return the transform of those instead
+  def get_transform(self, downsample=1, dimensions=None):
+    l_width, l_length, direction = dimensions or (self.l_width, self.l_length, self.direction)
+    size_step = self.SIZE_QUANTIZATION_STEP
+    angle_step = self.ANGLE_QUANTIZATION_STEP
+    width = max(1, int(round(l_width/float(size_step*downsample))*size_step))
+    length = max(1, int(round(l_length/float(size_step*downsample))*size_step))
+    direction = (round(direction/angle_step)*angle_step) % 360.0
+    return width, length, direction
+
+  # get_transformed_surfaces: return the (alpha, color) surfaces scaled to
+  # the projection dimensions and rotated to the light's direction
+  def get_transformed_surfaces(self, downsample=1):
+    width, length, direction = self.get_transform(downsample)
+    key = (self.falloff, self.color, width, length, direction)
+
+    surfaces = Light.surface_cache.get(key)
+    if surfaces is None:
+      alpha_surface = pygame.transform.scale(self.base_alpha_surface, (width, length))
+      color_surface = pygame.transform.scale(self.base_color_surface, (width, length))
+      surfaces = (pygame.transform.rotate(alpha_surface, direction),
+                  pygame.transform.rotate(color_surface, direction))
+      Light.surface_cache.put(key, surfaces, sum([surface.get_width()*surface.get_height()*surface.get_bytesize()
+                                                  for surface in surfaces]))
+    return surfaces
+
+  # get_transformed_size: return the size get_transformed_surfaces()
+  # would return surfaces of, without making them. This is the bounding
+  # box pygame.transform.rotate gives the scaled surface
+  def get_transformed_size(self, downsample=1, dimensions=None):
+    width, length, direction = self.get_transform(downsample, dimensions)
+    if direction % 90.0 == 0:
+      return (length, width) if direction % 180.0 else (width, length)
+    cos, sin = math.cos(math.radians(direction)), math.sin(math.radians(direction))
+    return (int(abs(cos*width) + abs(sin*length)), int(abs(sin*width) + abs(cos*length)))
@@ -0,0 +1,194 @@
+import pygame, math, numpy
+
+class LightBuffer():
+  QUALITY_LEVELS = (1, 2, 4)       # downsample factors of the buffer,
+                                   #   from finest to coarsest
+  SMOOTH_UPSCALE = False           # filter the upscaled buffer, which hides
+                                   #   blocky shadow edges at a fixed cost per view
+  MAX_SHARED_AREA = 1.5            # views share one surface while the box around
+                                   #   them is at most this many times their area
+
+  # LightBuffer constructor:
+  # a world-space layer of darkness and light, accumulated once per frame
+  # over the union of every active view. Each Camera then draws its own
+  # part of it, so an extra view (a minimap, a second player) costs a
+  # blit rather than a full relight. Views far apart (split-screen
+  # players on opposite sides of the level) get a surface each, rather
+  # than one spanning the gap. The buffer is downsample times smaller
+  # than the world: light and shadow are low frequency, so they can be
+  # accumulated at low resolution and upscaled per view
+  def __init__(self, downsample=1):
+    self.layers = []        # (origin, surface, box) of each group of views, see
+                            #   group_views(); origin is the real position of
+                            #   the surface's top left corner
+    self.upscaled = {}      # size -> scratch surface for upscaling a view's part
+    self.white = None       # white surface stencils are copied from, see clip_shadows()
+    self.set_downsample(downsample)
+
+  def set_downsample(self, factor):
+    self.downsample = factor
+    self.layers = []
+    self.upscaled = {}
+
+  # cycle_quality: switch to the next coarser quality level,
+  # wrapping around to the finest
+  def cycle_quality(self):
+    levels = self.QUALITY_LEVELS
+    if self.downsample in levels:
+      self.set_downsample(levels[(levels.index(self.downsample) + 1) % len(levels)])
+    else:
+      self.set_downsample(levels[0])
+
+  # accumulate: given the (top left, bottom right) corners of every
+  # active view, and the lights to render, fill the buffer with this
+  # frame's lighting. Lights which reach none of the views are skipped
+  def accumulate(self, views, list_of_lights):
+    layers = []
+    for index, (box, group) in enumerate(group_views(views, self.MAX_SHARED_AREA)):
+      surface = self.layers[index][1] if index < len(self.layers) else None
+      layers.append(self.accumulate_layer(box, group, list_of_lights, surface))
+    self.layers = layers
+
+  # accumulate_layer: light one group of views, whose union is box, onto
+  # surface (or a new one, if it isn't the right size). Returns the
+  # (origin, surface, box) of the layer
+  def accumulate_layer(self, box, views, list_of_lights, surface):
+    downsample = float(self.downsample)
+    (left, top), (right, bot) = box
+    # one spare pixel, for views which don't start on a buffer pixel
+    size = (int(math.ceil((right - left)/downsample)) + 1, int(math.ceil((bot - top)/downsample)) + 1)
+    if surface is None or surface.get_size() != size:
+      surface = pygame.Surface(size, pygame.SRCALPHA)
+
+    # fill the buffer with darkness, full alpha
+    surface.fill((1,1,1,255))
+
+    # for every light that reaches a view, subtract its alpha value
+    # from the darkness
+    for light in list_of_lights:
+      (light_left, light_top), (light_right, light_bot) = light.get_projection_bounds()
+      if not any(light_right >= x1 and light_left <= x2 and light_bot >= y1 and light_top <= y2
+                 for (x1, y1), (x2, y2) in views):
+        continue
+
+      alpha_surface, color_surface = light.get_transformed_surfaces(self.downsample)
+
+      # offset the center by the rotated surface's dimensions
+      light_bpos = (int((light.proj_pos.x - left)/downsample - alpha_surface.get_width()/2),
+                    int((light.proj_pos.y - top)/downsample - alpha_surface.get_height()/2))
+      alpha_surface, color_surface = self.clip_shadows(light, alpha_surface, color_surface,
+                                                       (left + light_bpos[0]*downsample,
+                                                        top + light_bpos[1]*downsample))
+
+      surface.blit(alpha_surface, light_bpos, None, pygame.BLEND_RGBA_SUB)
+
+      surface.blit(color_surface, light_bpos, None, pygame.BLEND_RGB_ADD)
+    return (left, top), surface, box
+
+  # clip_shadows: remove the light the emitter can't see from a light's
+  # own contribution, before it's blended into the buffer, so that its
+  # shadows don't darken what other lights shine on. Given the light's
+  # transformed (alpha, color) surfaces and the real position of their
+  # top left corner, return them with the areas in shadow cleared. The
+  # shadow polygons are moved into place all at once, and drawn onto a
+  # stencil the size of the light, which clips them to it
+  def clip_shadows(self, light, alpha_surface, color_surface, corner):
+    if not light.polylist:
+      return alpha_surface, color_surface
+    width, height = alpha_surface.get_size()
+    polygons = (numpy.array(light.polylist, dtype=float) - corner)/self.downsample
+    lower, upper = polygons.min(axis=1), polygons.max(axis=1)
+    inside = (upper[:, 0] >= 0) & (lower[:, 0] < width) & (upper[:, 1] >= 0) & (lower[:, 1] < height)
+    if not inside.any():
+      return alpha_surface, color_surface
+
+    stencil = self.get_blank_stencil(width, height)
+    for polygon in polygons[inside].tolist():
+      pygame.draw.polygon(stencil, (0,0,0,0), polygon, 0)
+
+    # multiplying by the stencil keeps what's lit, and clears the rest.
+    # Black lights add no color, so theirs is left as it is
+    if light.color[:3] != (0, 0, 0):
+      local_color = stencil.copy()
+      local_color.blit(color_surface, (0, 0), None, pygame.BLEND_RGBA_MULT)
+      color_surface = local_color
+    stencil.blit(alpha_surface, (0, 0), None, pygame.BLEND_RGBA_MULT)
+    return stencil, color_surface
+
+  # get_blank_stencil: return a new width by height stencil, white all
+  # over. Copying it out of a white surface kept around (which only
+  # ever grows) is much faster than filling a new one
+  def get_blank_stencil(self, width, height):
+    if self.white is None or self.white.get_width() < width or self.white.get_height() < height:
+      size = (width, height)
+      if self.white is not None:
+        size = (max(width, self.white.get_width()), max(height, self.white.get_height()))
+      self.white = pygame.Surface(size, pygame.SRCALPHA)
+      self.white.fill((255,255,255,255))
+    return self.white.subsurface((0, 0, width, height)).copy()
+
+  # draw: bring the part of the buffer under a view up to screen
+  # resolution, and blit it onto the screen at dest
+  def draw(self, screen, view, dest=(0, 0)):
+    downsample = self.downsample
+    (left, top), (right, bot) = view
+    origin, surface = self.get_layer(view)
+    x, y = (left - origin[0])/float(downsample), (top - origin[1])/float(downsample)
+    area = pygame.Rect(int(x), int(y),
+                       int(math.ceil((right - left)/float(downsample) + x - int(x))),
+                       int(math.ceil((bot - top)/float(downsample) + y - int(y))))
+    area = area.clip(surface.get_rect())
+    # shift by however far into its first buffer pixel the view starts
+    dest = (dest[0] - (x - area.x)*downsample, dest[1] - (y - area.y)*downsample)
+
+    if downsample == 1:
+      return screen.blit(surface, dest, area)
+
+    size = (area.width*downsample, area.height*downsample)
+    if size not in self.upscaled:
+      self.upscaled[size] = pygame.Surface(size, pygame.SRCALPHA)
+    if self.SMOOTH_UPSCALE:
+      upscale = pygame.transform.smoothscale
+    else:
+      upscale = pygame.transform.scale
+    upscale(surface.subsurface(area), size, self.upscaled[size])
+    return screen.blit(self.upscaled[size], dest)
+
+  # get_layer: return the (origin, surface) of the layer a view was
+  # accumulated into
+  def get_layer(self, view):
+    (left, top), (right, bot) = view
+    for origin, surface, ((x1, y1), (x2, y2)) in self.layers:
+      if x1 <= left and y1 <= top and right <= x2 and bot <= y2:
+        return origin, surface
+    raise ValueError("view %s wasn't accumulated this frame" % (view,))
+
+# group_views: given the (top left, bottom right) corners of a list of
+# views, return a list of (box, views) of the groups they're lit in.
+# Views are grouped as long as the box around a group is at most
+# max_area times the area of the boxes it joins, so overlapping views
+# share a surface, and views far apart don't
+def group_views(views, max_area):
+  groups = [(view, [view]) for view in views]
+  merged = True
+  while merged:
+    merged = False
+    for i in range(len(groups)):
+      for j in range(i + 1, len(groups)):
+        box = get_union(groups[i][0], groups[j][0])
+        if get_area(box) <= max_area*(get_area(groups[i][0]) + get_area(groups[j][0])):
+          groups[i] = (box, groups[i][1] + groups[j][1])
+          del groups[j]
+          merged = True
+          break
+      if merged:
+        break
+  return groups
+
+def get_union(box_1, box_2):
+  ((ax1, ay1), (ax2, ay2)), ((bx1, by1), (bx2, by2)) = box_1, box_2
+  return ((min(ax1, bx1), min(ay1, by1)), (max(ax2, bx2), max(ay2, by2)))
+
+def get_area(box):
+  (x1, y1), (x2, y2) = box
+  return (x2 - x1)*(y2 - y1)
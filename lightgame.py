@@ -1,73 +1,216 @@
-import pygame, sys, os, math
-from entity import Entity, Player
-from level import Level
-from camera import Camera
-from random import randint, choice
-from pygame.sprite import Sprite
-from pymunk.vec2d import Vec2d
-
-globals = { 'SCREEN_WIDTH': 1000,
+import pygame, sys, os, math, time, random
+from dirtyrects import DirtyRectRenderer
+from lightbuffer import LightBuffer
+from lightpool import LightPool
+from world import World
+from replay import TraceRecorder, TracePlayer
+import profiler
+from profiler import frame_profiler
+
+globals = { 'LEVEL_PATH': 'testlevel.txt',
+            'CHUNKED_LEVEL': False,      # LEVEL_PATH is a chunk file, streamed in as the game runs
+            'SCREEN_WIDTH': 1000,
             'SCREEN_HEIGHT': 1000,
-            'WASD_KEYS': (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d),
-            'BG_COLOR': (0, 0, 0) }
+            'BG_COLOR': (0, 0, 0),
+            'DIRTY_RECTS': False,        # only push changed areas of the screen
+            'PROFILE_PATH': 'profile',   # stage timings are dumped to this, plus .json/.csv
+            'LIGHT_POOL': None,          # 'threads' or 'processes' to compute light geometry in parallel
+            'PIPELINE_LIGHTS': False,    # compute a frame's light geometry while the last one renders
+            'SIMULATION_HZ': 50,         # fixed rate the game is simulated at
+            'FRAME_RATE_CAP': 50,        # most frames drawn per second, or 0 for uncapped
+            'MAX_CATCH_UP_STEPS': 5,     # most simulation steps run between two drawn frames
+            'MAX_FRAME_TIME': 250,       # ms; longer frames (e.g. a stall) are cut down to this
+            'NPC_COUNT': 0,              # wandering robots to fill the level with
+            'SEED': None,                # NPCs are spawned from this seed, or a random one
+            'RECORD_PATH': None,         # the session's input is traced to this file, see replay.py
+            'REPLAY_PATH': None,         # a trace to play instead of reading input
+            'REPLAY_FAST': False,        # replay as fast as possible, not at the recorded pace
+            'REPLAY_OUTPUT': 'replay.json' } # every replayed frame's stage timings go here
+
+# the settings a session is replayed with, as they were recorded
+TRACED_SETTINGS = ('LEVEL_PATH', 'CHUNKED_LEVEL', 'SCREEN_WIDTH', 'SCREEN_HEIGHT', 'SIMULATION_HZ',
+                   'FRAME_RATE_CAP', 'MAX_CATCH_UP_STEPS', 'MAX_FRAME_TIME', 'NPC_COUNT', 'SEED')
 
 def run_game():
   
+  startup_time = profiler.clock()
+
+  # a replay runs with the settings it was recorded with, and keeps the
+  # timings of all its frames
+  replay = None
+  if globals['REPLAY_PATH']:
+    replay = TracePlayer(globals['REPLAY_PATH'])
+    globals.update(replay.header["settings"])
+    frame_profiler.reset(len(replay))
+  if globals['SEED'] is None:
+    globals['SEED'] = random.randrange(2**31)
+  recorder = None
+  if globals['RECORD_PATH']:
+    recorder = TraceRecorder({ "settings": dict((name, globals[name]) for name in TRACED_SETTINGS) })
+
   pygame.init()
   clock = pygame.time.Clock()
   screen = pygame.display.set_mode((globals['SCREEN_WIDTH'], globals['SCREEN_HEIGHT']), 0, 32)
   
   currently_held_keys = []
   
-  #debug stuff
-  lvl = Level("testlevel.txt", screen) 
-  playerCam = Camera((85,85), globals['SCREEN_WIDTH'], globals['SCREEN_HEIGHT'])
-  originCam = Camera((0,0), globals['SCREEN_WIDTH'], globals['SCREEN_HEIGHT'])
-  player = Player("resources/robodude.png", screen, (85,85), playerCam)
-  currentCam = player.camera
-  entities = []
+  light_pool = None
+  if globals['LIGHT_POOL']:
+    light_pool = LightPool(globals['LIGHT_POOL'], pipelined=globals['PIPELINE_LIGHTS'])
+  world = World(globals['LEVEL_PATH'], screen, (globals['SCREEN_WIDTH'], globals['SCREEN_HEIGHT']),
+                globals['NPC_COUNT'], light_pool, globals['SEED'], globals['CHUNKED_LEVEL'])
+  lvl, player, entity_store = world.level, world.player, world.entity_store
+  # lighting is accumulated once per frame over every view, and each
+  # camera draws its part of it
+  light_buffer = LightBuffer()
   
-  entities.append(player)
+  dirty_rects = DirtyRectRenderer(screen)
+  last_render_light = True
+
+  # the game is simulated in fixed steps, as many as the time drawing
+  # took, and drawn in between the last two of them. When drawing falls
+  # behind, frames are skipped rather than steps, MAX_CATCH_UP_STEPS at
+  # a time
+  step_time = 1000.0 / globals['SIMULATION_HZ']
+  unsimulated_time = 0.0
+  frame = 0
+  replay_deadline = profiler.clock() # when the replayed frame is due, at the recorded pace
  
   while True:
-    for event in pygame.event.get():
-      if event.type == pygame.QUIT:
-        exit_game()
-      if event.type == pygame.KEYDOWN:
-        currently_held_keys.append(event.key)
-      if event.type == pygame.KEYUP:
-        currently_held_keys.remove(event.key)
+    frame_profiler.begin_frame()
+    with frame_profiler.stage("events"):
+      pressed_keys = []
+      for event in pygame.event.get():
+        if event.type == pygame.QUIT:
+          finish_session(recorder, replay)
+          world.close()
+          exit_game()
+        if replay is not None:
+          continue
+        if event.type == pygame.KEYDOWN:
+          currently_held_keys.append(event.key)
+          pressed_keys.append(event.key)
+        if event.type == pygame.KEYUP:
+          currently_held_keys.remove(event.key)
+
+      if replay is not None:
+        if frame == len(replay):
+          finish_session(recorder, replay)
+          world.close()
+          exit_game()
+        currently_held_keys, mouse_pos = replay.get_input(frame)
+        pressed_keys = replay.get_pressed(frame)
+      else:
+        mouse_pos = pygame.mouse.get_pos()
+
+      for key in pressed_keys:
+        if key == pygame.K_3:
+          light_buffer.cycle_quality()
+          dirty_rects.invalidate()
+        if key == pygame.K_4:
+          frame_profiler.toggle_overlay()
+          dirty_rects.invalidate()
+        if key == pygame.K_5:
+          frame_profiler.dump_json(globals['PROFILE_PATH'] + ".json")
+          frame_profiler.dump_csv(globals['PROFILE_PATH'] + ".csv")
     
-    currentCam = player.camera
     do_render_light = True
 
     for keydown in currently_held_keys:
-      if keydown in globals['WASD_KEYS']:
-        player.movement_handler(keydown)
       #debug stuff
-      if keydown == pygame.K_1:
-        currentCam = originCam
       if keydown == pygame.K_2:
         do_render_light = False
     
-    time_passed = clock.tick(50)
+    with frame_profiler.stage("wait"):
+      if replay is None:
+        time_passed = clock.tick(globals['FRAME_RATE_CAP'])
+      else:
+        # replay the time frames took, rather than measuring it
+        time_passed = replay.get_time_passed(frame)
+        if not globals['REPLAY_FAST']:
+          replay_deadline += time_passed/1000.0
+          delay = replay_deadline - profiler.clock()
+          if delay > 0:
+            time.sleep(delay)
+          else:
+            replay_deadline -= delay # running behind, so don't try to catch up
+        clock.tick()
+    if recorder is not None:
+      recorder.record(min(time_passed, 2**16 - 1), currently_held_keys, pressed_keys, mouse_pos)
+    frame += 1
+    unsimulated_time += min(time_passed, globals['MAX_FRAME_TIME'])
+
+    with frame_profiler.stage("player.update"):
+      steps = 0
+      while unsimulated_time >= step_time and steps < globals['MAX_CATCH_UP_STEPS']:
+        world.step(step_time, currently_held_keys)
+        unsimulated_time -= step_time
+        steps += 1
+    if unsimulated_time >= step_time:
+      # still behind, so skip drawing this frame
+      frame_profiler.end_frame()
+      continue
+
     screen.fill(globals['BG_COLOR'])
 
     # debug stuff
-    pygame.display.set_caption('Lightgame : %d fps' % clock.get_fps())
+    pygame.display.set_caption('Lightgame : %d fps, %d/%d lights' %
+                               (clock.get_fps(), world.light_index.visible_count, len(world.light_index)))
+    with frame_profiler.stage("player.update_view"):
+      currentCam, views = world.update_view(unsimulated_time / step_time, currently_held_keys, mouse_pos)
     corners = currentCam.get_corners()
-    lvl.draw_visible_level(corners[0], corners[1])
-    player.update(time_passed, lvl, currentCam)
+    with frame_profiler.stage("draw_visible_level"):
+      lvl.draw_visible_level(corners[0], corners[1])
+    # only lights near the camera were updated, so only render those
+    visible_lights = world.gather_lights()
+    npc_rects = entity_store.draw(currentCam)
     player.draw(currentCam)
     
-    lights_per_entity = [entity.lights for entity in entities]
-    all_lights = [light for lights in lights_per_entity for light in lights]
     if do_render_light:
-      currentCam.render_light(screen, all_lights)
+      with frame_profiler.stage("render_light"):
+        light_buffer.accumulate(views, visible_lights)
+        currentCam.draw_light(screen, light_buffer)
+
+    overlay_rect = frame_profiler.draw_overlay(screen)
+
+    if globals['DIRTY_RECTS']:
+      for entity in world.entities:
+        dirty_rects.mark_entity(entity, currentCam)
+      for rect in npc_rects:
+        dirty_rects.mark(rect)
+      dirty_rects.mark_level(lvl, currentCam)
+      for light in visible_lights:
+        dirty_rects.mark_light(light, currentCam, light_buffer.downsample)
+      if do_render_light != last_render_light:
+        dirty_rects.invalidate()
+      last_render_light = do_render_light
+      if overlay_rect:
+        dirty_rects.mark(overlay_rect)
+      with frame_profiler.stage("flip"):
+        dirty_rects.present(currentCam)
+    else:
+      with frame_profiler.stage("flip"):
+        pygame.display.flip()
+    frame_profiler.end_frame()
+
+    if startup_time is not None:
+      print(lvl.get_load_report())
+      print("first frame after %.1f ms" % ((profiler.clock() - startup_time)*1000.0))
+      startup_time = None
 
-    pygame.display.flip()
+# finish_session: save the input trace of the session, if it was
+# recorded, or the frame timings of the replay, if it was replayed
+def finish_session(recorder, replay):
+  if recorder is not None:
+    recorder.save(globals['RECORD_PATH'])
+    print("recorded %d frames to %s" % (len(recorder), globals['RECORD_PATH']))
+  if replay is not None:
+    frame_profiler.dump_json(globals['REPLAY_OUTPUT'])
+    for name, p50, p95, peak in frame_profiler.get_stats():
+      print("%-20s p50 %7.2f ms  p95 %7.2f ms  max %7.2f ms" % (name, p50, p95, peak))
 
 def exit_game():
   sys.exit()
 
-run_game()
+if __name__ == "__main__":
+  run_game()
@@ -0,0 +1,86 @@
+class LightIndex():
+  CELL_SIZE = 256    # size, in pixels, of the grid cells lights are filed under
+  VIEW_MARGIN = 64   # pixels around each view in which lights still count as
+                     #   visible, since lights are culled against where the
+                     #   camera was before it followed the player
+
+  # LightIndex constructor:
+  # a uniform grid of the lights in the world, filed under every cell
+  # their projection bounds overlap, so that only lights near the
+  # active views need to be updated and rendered
+  def __init__(self):
+    self.cells = {}        # (cell x, cell y) -> set of lights
+    self.light_cells = {}  # light -> list of the cells it's filed under
+    self.light_bounds = {} # light -> bounds it was last filed by
+    self.light_order = {}  # light -> insertion count, to keep rendering order stable
+    self.insertions = 0
+    self.views = []
+
+    # counters for the current frame, for profiling
+    self.visible_count = 0
+    self.culled_count = 0
+
+  def __len__(self):
+    return len(self.light_cells)
+
+  def get_cells(self, box):
+    (x1, y1), (x2, y2) = box
+    return [(cx, cy) for cy in range(int(y1 // self.CELL_SIZE), int(y2 // self.CELL_SIZE) + 1)
+                     for cx in range(int(x1 // self.CELL_SIZE), int(x2 // self.CELL_SIZE) + 1)]
+
+  def insert(self, light):
+    self.light_cells[light] = []
+    self.light_order[light] = self.insertions
+    self.insertions += 1
+    self.move(light)
+
+  def remove(self, light):
+    del self.light_order[light]
+    del self.light_bounds[light]
+    for cell in self.light_cells.pop(light):
+      self.cells[cell].discard(light)
+
+  # move: re-file a light under the cells its current bounds overlap,
+  # after its emitter or projection has moved. These are the bounds it
+  # will have once updated, not those of its last update: a culled
+  # light isn't updated, so those could stay too small to ever be seen
+  def move(self, light):
+    self.light_bounds[light] = light.get_target_bounds()
+    cells = self.get_cells(self.light_bounds[light])
+    if cells == self.light_cells[light]:
+      return
+    for cell in self.light_cells[light]:
+      self.cells[cell].discard(light)
+    for cell in cells:
+      self.cells.setdefault(cell, set()).add(light)
+    self.light_cells[light] = cells
+
+  # set_views: given the (top left, bottom right) corners of every
+  # active camera, start a new frame looking at them
+  def set_views(self, views):
+    self.views = [((x1 - self.VIEW_MARGIN, y1 - self.VIEW_MARGIN),
+                   (x2 + self.VIEW_MARGIN, y2 + self.VIEW_MARGIN)) for (x1, y1), (x2, y2) in views]
+
+  # is_visible: return whether the light's bounds, as of its last
+  # move(), intersect any view
+  def is_visible(self, light):
+    (lx1, ly1), (lx2, ly2) = self.light_bounds[light]
+    for (vx1, vy1), (vx2, vy2) in self.views:
+      if lx1 <= vx2 and lx2 >= vx1 and ly1 <= vy2 and ly2 >= vy1:
+        return True
+    return False
+
+  # visible_lights: return the list of lights which intersect any view,
+  # in the order they were inserted, updating the visible/culled
+  # counters for this frame
+  def visible_lights(self):
+    candidates = set()
+    for view in self.views:
+      for cell in self.get_cells(view):
+        candidates.update(self.cells.get(cell, ()))
+    visible = sorted([light for light in candidates if self.is_visible(light)],
+                     key=lambda light: self.light_order[light])
+
+    self.visible_count = len(visible)
+    self.culled_count = len(self.light_cells) - len(visible)
+    return visible
@@ -0,0 +1,162 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from light import Light
+
+# the occluder snapshot in a worker process, set by the pool's initializer
+worker_level = None
+
+def set_worker_level(level):
+  global worker_level
+  worker_level = level
+
+# get_worker_shadow_geometry: given a task of (tile edits since the
+# snapshot the worker started with, the level version they bring it
+# to, light job), catch the worker's snapshot up, and compute the job
+def get_worker_shadow_geometry(task):
+  edits, version, job = task
+  if worker_level.version != version:
+    worker_level.apply_edits(edits, version)
+  return Light.get_shadow_geometry(job, worker_level)
+
+class LightPool():
+  MODES = ("serial", "threads", "processes")
+  MAX_WORKER_EDITS = 256 # tile edits sent along with every task before the
+                         #   worker processes are restarted on a new snapshot
+
+  # LightPool constructor:
+  # fans the shadow geometry of every light updated in a frame out to a
+  # pool of worker threads or processes, computed against a read-only
+  # occluder snapshot of the level. Lights are submit()ted as they're
+  # moved, then gather() must be called before they're rendered.
+  # Results are committed in submission order, and are exactly what
+  # update_surface would have computed. In pipelined mode, gather()
+  # doesn't wait: the geometry of frame N is computed while frame N is
+  # rendered with the geometry of frame N-1, so shadows lag a frame
+  # behind the lights
+  def __init__(self, mode="threads", workers=None, pipelined=False):
+    if mode not in self.MODES:
+      raise ValueError("unknown light pool mode %s" % mode)
+    self.mode = mode
+    self.workers = workers or multiprocessing.cpu_count()
+    self.pipelined = pipelined and mode != "serial"
+    self.pool = None
+    self.level = None
+    self.level_version = None
+    self.snapshot = None
+    self.pool_version = None # level version of the worker processes' snapshot
+    self.worker_edits = []   # edits to the level since then
+
+    self.queued = []     # (light, job) submitted since the last gather()
+    self.in_flight = []  # (light, job, async result) of the last pipelined gather()
+    self.in_flight_lights = {} # light -> index in in_flight, for those not yet committed
+
+  # set_level: take a new snapshot of the level to compute geometry
+  # against, restarting the worker processes if there are any
+  def set_level(self, level):
+    if self.queued:
+      self.gather()
+    self.finish_in_flight()
+    self.level = level
+    self.level_version = level.version
+    self.snapshot = level.get_occluder_snapshot()
+    self.pool_version = level.version
+    self.worker_edits = []
+    if self.mode == "threads" and self.pool is None:
+      self.pool = ThreadPool(self.workers)
+    elif self.mode == "processes":
+      self.close()
+      self.pool = multiprocessing.Pool(self.workers, set_worker_level, (self.snapshot,))
+
+  # update_level: after set_tile() has changed the level, apply the
+  # edits to the snapshot. Worker processes keep theirs, and are sent
+  # every edit since it was taken with each task, until there are more
+  # than MAX_WORKER_EDITS of them
+  def update_level(self):
+    if self.queued:
+      self.gather()
+    self.finish_in_flight()
+    level = self.level
+    self.snapshot.apply_edits(level.get_edits_since(self.snapshot.version), level.version)
+    self.level_version = level.version
+    if self.mode == "processes":
+      self.worker_edits = level.get_edits_since(self.pool_version)
+      if len(self.worker_edits) > self.MAX_WORKER_EDITS:
+        self.set_level(level)
+
+  # submit: the pooled version of light.update_surface(level)
+  def submit(self, light, level):
+    if level is not self.level:
+      self.set_level(level)
+    elif level.version != self.level_version:
+      self.update_level()
+    # the light's next state starts from the one still being computed
+    if light in self.in_flight_lights:
+      self.finish_in_flight(light)
+
+    job = light.begin_update(level)
+    if job is not None:
+      self.queued.append((light, job))
+
+  # gather: compute the geometry of every light submitted since the last
+  # call, and move them into their new states. In pipelined mode, only
+  # start computing it, and commit what was started last time
+  def gather(self):
+    queued, self.queued = self.queued, []
+    jobs = [job for light, job in queued]
+    if not jobs and not self.pipelined:
+      return
+    if self.mode == "serial":
+      geometry = [Light.get_shadow_geometry(job, self.snapshot) for job in jobs]
+    elif not self.pipelined:
+      geometry = self.map_jobs(jobs).get()
+    else:
+      self.finish_in_flight()
+      self.in_flight = [(light, job, result) for (light, job), result in
+                        zip(queued, self.apply_jobs(jobs))]
+      self.in_flight_lights = dict((light, i) for i, (light, job, result) in enumerate(self.in_flight))
+      return
+
+    for (light, job), light_geometry in zip(queued, geometry):
+      light.finish_update(job, light_geometry)
+
+  def get_job_function(self):
+    if self.mode == "processes":
+      return get_worker_shadow_geometry
+    snapshot = self.snapshot
+    return lambda job: Light.get_shadow_geometry(job, snapshot)
+
+  # get_tasks: return what's sent to the pool for each of a list of jobs.
+  # Worker processes need the edits their snapshot is missing too
+  def get_tasks(self, jobs):
+    if self.mode == "processes":
+      return [(self.worker_edits, self.level_version, job) for job in jobs]
+    return jobs
+
+  # map_jobs: start computing the geometry of a list of jobs on the
+  # pool, returning one async result for all of it
+  def map_jobs(self, jobs):
+    return self.pool.map_async(self.get_job_function(), self.get_tasks(jobs))
+
+  # apply_jobs: start computing the geometry of a list of jobs on the
+  # pool, returning an async result for each job
+  def apply_jobs(self, jobs):
+    function = self.get_job_function()
+    return [self.pool.apply_async(function, (task,)) for task in self.get_tasks(jobs)]
+
+  # finish_in_flight: commit the pipelined geometry of one light, or of
+  # every light, waiting for it if it's still being computed
+  def finish_in_flight(self, light=None):
+    if light is None:
+      lights = list(self.in_flight_lights)
+    else:
+      lights = [light]
+    for light in lights:
+      light, job, result = self.in_flight[self.in_flight_lights.pop(light)]
+      light.finish_update(job, result.get())
+    if not self.in_flight_lights:
+      self.in_flight = []
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool = None
@@ -0,0 +1,138 @@
+import pygame, time, json, numpy
+
+if hasattr(time, "perf_counter"):
+  clock = time.perf_counter
+else:
+  clock = time.time
+
+class FrameProfiler():
+  HISTORY_SIZE = 300                 # frames of stage timings kept
+  OVERLAY_COLOR = (255, 255, 255)
+  OVERLAY_BACKGROUND = (0, 0, 0, 180)
+
+  # FrameProfiler constructor:
+  # records how long each named stage of a frame took, over the last
+  # HISTORY_SIZE frames. Every frame is bracketed by begin_frame() and
+  # end_frame(); stages are timed with "with profiler.stage(name):",
+  # and a stage entered several times in a frame (e.g. once per light)
+  # is summed
+  def __init__(self, history_size=HISTORY_SIZE):
+    self.history_size = history_size
+    self.stage_order = []   # stage names, in the order first seen
+    self.history = {}       # stage name -> ring buffer of times, in seconds
+    self.current = {}       # stage name -> time spent in it this frame
+    self.frames = 0         # frames recorded since the profiler was made
+    self.frame_start = None
+    self.show_overlay = False
+    self.font = None
+
+  # reset: forget every recorded frame, and keep history_size frames
+  # from now on, e.g. all the frames of a replay
+  def reset(self, history_size=None):
+    self.__init__(history_size or self.history_size)
+
+  def begin_frame(self):
+    self.current = {}
+    self.frame_start = clock()
+
+  def stage(self, name):
+    return ProfileStage(self, name)
+
+  def add(self, name, seconds):
+    self.current[name] = self.current.get(name, 0.0) + seconds
+
+  # end_frame: write this frame's stage times into the ring buffer.
+  # The whole frame is recorded too, as the stage "frame"
+  def end_frame(self):
+    if self.frame_start is not None:
+      self.current["frame"] = clock() - self.frame_start
+    row = self.frames % self.history_size
+    for name in self.current:
+      if name not in self.history:
+        self.stage_order.append(name)
+        self.history[name] = numpy.zeros(self.history_size)
+    for name in self.stage_order:
+      self.history[name][row] = self.current.get(name, 0.0)
+    self.frames += 1
+    self.frame_start = None
+
+  # get_recorded: return {stage name: times of the recorded frames,
+  # oldest first}
+  def get_recorded(self):
+    count = min(self.frames, self.history_size)
+    start = self.frames % self.history_size if self.frames > self.history_size else 0
+    order = (numpy.arange(count) + start) % self.history_size
+    return dict((name, self.history[name][order]) for name in self.stage_order)
+
+  # get_stats: return a list of (stage name, p50, p95, max) over the
+  # recorded frames, in milliseconds
+  def get_stats(self):
+    recorded = self.get_recorded()
+    stats = []
+    for name in self.stage_order:
+      times = recorded[name]*1000.0
+      if len(times):
+        p50, p95 = numpy.percentile(times, [50, 95])
+        stats.append((name, p50, p95, times.max()))
+    return stats
+
+  def toggle_overlay(self):
+    self.show_overlay = not self.show_overlay
+
+  # draw_overlay: draw a table of the stats in the top left of the
+  # screen, if the overlay is on. Returns the rect drawn over, or None
+  def draw_overlay(self, screen):
+    if not self.show_overlay:
+      return None
+    if self.font is None:
+      pygame.font.init()
+      self.font = pygame.font.SysFont("monospace", 14)
+
+    lines = ["%-20s %7s %7s %7s" % ("stage (ms)", "p50", "p95", "max")]
+    for name, p50, p95, peak in self.get_stats():
+      lines.append("%-20s %7.2f %7.2f %7.2f" % (name, p50, p95, peak))
+    rendered = [self.font.render(line, True, self.OVERLAY_COLOR) for line in lines]
+
+    line_height = self.font.get_linesize()
+    width = max([text.get_width() for text in rendered]) + 8
+    background = pygame.Surface((width, line_height*len(rendered) + 8), pygame.SRCALPHA)
+    background.fill(self.OVERLAY_BACKGROUND)
+    for i, text in enumerate(rendered):
+      background.blit(text, (4, 4 + i*line_height))
+    return screen.blit(background, (0, 0))
+
+  # dump_json: write the stats and every recorded frame's stage times,
+  # in milliseconds, to a JSON file
+  def dump_json(self, path):
+    recorded = self.get_recorded()
+    out = open(path, "w")
+    json.dump({ "stats": [dict(zip(("stage", "p50", "p95", "max"), stat)) for stat in self.get_stats()],
+                "frames": dict((name, (times*1000.0).tolist()) for name, times in recorded.items()) },
+              out, indent=1, sort_keys=True)
+    out.close()
+
+  # dump_csv: write every recorded frame's stage times, in
+  # milliseconds, to a CSV file with one row per frame
+  def dump_csv(self, path):
+    recorded = self.get_recorded()
+    out = open(path, "w")
+    out.write(",".join(self.stage_order) + "\n")
+    for row in range(min(self.frames, self.history_size)):
+      out.write(",".join(["%.4f" % (recorded[name][row]*1000.0) for name in self.stage_order]) + "\n")
+    out.close()
+
+class ProfileStage():
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.start = clock()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.profiler.add(self.name, clock() - self.start)
+    return False
+
+# the profiler the game loop and the subsystems it calls record into
+frame_profiler = FrameProfiler()
@@ -0,0 +1,156 @@
+# replay.py: record play sessions as input traces, and replay them
+# deterministically to time every frame. Set RECORD_PATH in lightgame's
+# globals to record a session, then:
+#   python replay.py trace.npz [--fast] [--output timings.json]
+#   python replay.py --compare before.json after.json
+import json, argparse, numpy
+import pygame
+
+TRACE_VERSION = 1
+# the keys whose state is traced: movement, the debug camera and light
+# toggles, and the light quality and profiler overlay keys
+TRACKED_KEYS = (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d,
+                pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4)
+
+class TraceRecorder():
+
+  # TraceRecorder constructor:
+  # collects the input of every frame of a session: how long the frame
+  # took, which of TRACKED_KEYS were held (in the order they were
+  # pressed, which movement depends on) and which were pressed during
+  # it, and where the mouse was. header holds whatever else the session
+  # needs to be replayed the same way (e.g. the level and NPC seed)
+  def __init__(self, header):
+    self.header = dict(header, version=TRACE_VERSION, keys=list(TRACKED_KEYS))
+    self.times = []
+    self.held = []
+    self.pressed = []
+    self.mouse = []
+
+  def __len__(self):
+    return len(self.times)
+
+  def record(self, time_passed, held_keys, pressed_keys, mouse_pos):
+    self.times.append(time_passed)
+    self.held.append(get_key_sequence(held_keys))
+    self.pressed.append(get_key_mask(pressed_keys))
+    self.mouse.append(mouse_pos)
+
+  # save: write the trace as a compressed npz file, a few bytes a frame
+  def save(self, trace_path):
+    trace_file = open(trace_path, "wb")
+    numpy.savez_compressed(trace_file, header=json.dumps(self.header, sort_keys=True),
+                           times=numpy.array(self.times, dtype=numpy.uint16),
+                           held=numpy.array(self.held, dtype=numpy.uint32),
+                           pressed=numpy.array(self.pressed, dtype=numpy.uint16),
+                           mouse=numpy.array(self.mouse, dtype=numpy.int16).reshape(-1, 2))
+    trace_file.close()
+
+class TracePlayer():
+
+  # TracePlayer constructor:
+  # reads a trace written by TraceRecorder, and gives back the input of
+  # each of its frames. Like headless.RandomInput, it's an input source,
+  # so traces can also drive headless runs
+  def __init__(self, trace_path):
+    trace = numpy.load(trace_path)
+    self.header = json.loads(str(trace["header"]))
+    if self.header["version"] != TRACE_VERSION:
+      raise ValueError("%s is a version %s trace" % (trace_path, self.header["version"]))
+    self.keys = self.header["keys"]
+    self.times = trace["times"].tolist()
+    self.held = trace["held"].tolist()
+    self.pressed = trace["pressed"].tolist()
+    self.mouse = [tuple(pos) for pos in trace["mouse"].tolist()]
+    trace.close()
+
+  def __len__(self):
+    return len(self.times)
+
+  # get_input: return the (held keys, mouse position) of a frame
+  def get_input(self, frame):
+    return get_sequence_keys(self.held[frame], self.keys), self.mouse[frame]
+
+  # get_pressed: return the keys pressed during a frame
+  def get_pressed(self, frame):
+    return get_mask_keys(self.pressed[frame], self.keys)
+
+  # get_time_passed: return how long, in ms, a frame took when it was
+  # recorded
+  def get_time_passed(self, frame):
+    return self.times[frame]
+
+# Given a list of keys, return a bitmask of which of TRACKED_KEYS are in it
+def get_key_mask(keys):
+  mask = 0
+  for bit, key in enumerate(TRACKED_KEYS):
+    if key in keys:
+      mask |= 1 << bit
+  return mask
+
+# Given a bitmask from get_key_mask() and the keys it was made with,
+# return the list of keys set in it
+def get_mask_keys(mask, keys=TRACKED_KEYS):
+  return [key for bit, key in enumerate(keys) if mask & (1 << bit)]
+
+# Given a list of keys, return the order the ones of TRACKED_KEYS come
+# in, packed four bits a key. A key held twice counts once
+def get_key_sequence(keys):
+  tracked = []
+  for key in keys:
+    if key in TRACKED_KEYS and key not in tracked:
+      tracked.append(key)
+  sequence = 0
+  for shift, key in enumerate(tracked):
+    sequence |= (TRACKED_KEYS.index(key) + 1) << (4*shift)
+  return sequence
+
+# Given a packed order from get_key_sequence() and the keys it was made
+# with, return the list of keys in it
+def get_sequence_keys(sequence, keys=TRACKED_KEYS):
+  found = []
+  while sequence:
+    found.append(keys[(sequence & 15) - 1])
+    sequence >>= 4
+  return found
+
+# compare_timings: given two frame timing files written by replays of the
+# same trace (see FrameProfiler.dump_json), return a list of (stage,
+# (p50, p95, max) before, (p50, p95, max) after) for every stage in both
+def compare_timings(before_path, after_path):
+  stats = []
+  for path in (before_path, after_path):
+    timings_file = open(path)
+    stats.append(dict((stat["stage"], (stat["p50"], stat["p95"], stat["max"]))
+                      for stat in json.load(timings_file)["stats"]))
+    timings_file.close()
+  before, after = stats
+  return [(stage, before[stage], after[stage]) for stage in sorted(before) if stage in after]
+
+def main():
+  parser = argparse.ArgumentParser(description="Replay a lightgame input trace, timing every frame")
+  parser.add_argument("trace", nargs="?", help="trace file to replay")
+  parser.add_argument("--fast", action="store_true", help="replay as fast as possible, not at the recorded pace")
+  parser.add_argument("--output", default="replay.json", help="file to write the frame timings to")
+  parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                      help="compare the frame timings of two replays instead")
+  args = parser.parse_args()
+
+  if args.compare:
+    print("%-20s %23s %23s" % ("stage (ms)", "p50", "p95"))
+    for stage, before, after in compare_timings(*args.compare):
+      print("%-20s %7.2f -> %7.2f %+5.0f%% %7.2f -> %7.2f %+5.0f%%" %
+            (stage, before[0], after[0], (after[0]/before[0] - 1)*100 if before[0] else 0,
+             before[1], after[1], (after[1]/before[1] - 1)*100 if before[1] else 0))
+    return
+  if not args.trace:
+    parser.error("a trace file is needed to replay")
+
+  import lightgame
+  lightgame.globals['REPLAY_PATH'] = args.trace
+  lightgame.globals['REPLAY_FAST'] = args.fast
+  lightgame.globals['REPLAY_OUTPUT'] = args.output
+  lightgame.run_game()
+
+if __name__ == "__main__":
+  main()
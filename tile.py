@@ -1,4 +1,5 @@
-import pygame, sys, os, math
+import pygame, sys, os, math, numpy
+from assets import asset_manager
 from pymunk.vec2d import Vec2d
 from pygame.sprite import Sprite
 
@@ -21,22 +22,51 @@ types = { "wall": {"movethrough": False,
 char_to_type = { "#": "wall",
                  ".": "floor" }
 
-images = { "wall": "resources/wall.png",
-           "blank": "resources/blank.png",
-           "floor": "resources/floor.png" }
+# type codes, as stored in a Level's type grid. Cells past the end of
+# a short row hold EMPTY, which isn't a tile at all
+type_names = sorted(types)
+type_codes = dict((name, code) for code, name in enumerate(type_names))
+EMPTY = 255
+
+image_paths = { "wall": "resources/wall.png",
+                "blank": "resources/blank.png",
+                "floor": "resources/floor.png" }
+images = {} # type name -> image, filled in by Tile.load_images()
+
+# get_attribute_table: return an array mapping every type code to the
+# given attribute, so that it can be looked up over a whole grid of
+# codes at once. EMPTY cells get the default
+def get_attribute_table(attribute, default):
+  table = numpy.empty(EMPTY + 1, dtype=bool)
+  table[:] = default
+  for name, code in type_codes.items():
+    table[code] = types[name][attribute]
+  return table
+
+# get_code_table: return an array mapping every level file character
+# (as a byte) to its type code, with EMPTY for unknown characters
+def get_code_table():
+  table = numpy.empty(256, dtype=numpy.uint8)
+  table[:] = EMPTY
+  for char, name in char_to_type.items():
+    table[ord(char)] = type_codes[name]
+  return table
 
 class Tile(Sprite):
   @staticmethod  
   def load_images():
-    for key in images:
-      images[key] = pygame.image.load(images[key]).convert()
+    for key in image_paths:
+      images[key] = asset_manager.load_image(image_paths[key], alpha=False)
  
-  def __init__(self, screen, rxpos, rypos, tile_character, tile_dim):
+  # Tile constructor:
+  # tiles are only views onto a Level's type grid, created on demand;
+  # everything but the position is shared by all tiles of a type
+  def __init__(self, screen, rxpos, rypos, tile_type, tile_dim):
     Sprite.__init__(self)
     self.screen = screen
     self.rxpos = rxpos
     self.rypos = rypos
-    self.tile_type = char_to_type[tile_character]
+    self.tile_type = tile_type
     self.attributes = types[self.tile_type]
     self.image = images[self.tile_type]
     self.dimension = tile_dim
@@ -0,0 +1,107 @@
+import pygame
+from level import Level
+from chunkedlevel import ChunkedLevel
+from camera import Camera
+from entity import Player
+from entitystore import EntityStore
+from lightindex import LightIndex
+from profiler import frame_profiler
+from random import Random
+from pymunk.vec2d import Vec2d
+
+WASD_KEYS = (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d)
+ORIGIN_CAMERA_KEY = pygame.K_1 # while held, look through the camera at the origin
+SPAWN_ATTEMPTS = 1000          # random spots tried for each NPC before giving up
+
+class World():
+
+  # World constructor:
+  # everything which is simulated: the level, the player and the NPCs,
+  # the cameras and the lights, but none of the drawing. The game loop
+  # draws a world after stepping it; headless runs only step it. Given a
+  # seed, NPCs are spawned the same way every time. If chunked, the
+  # level is a chunk file, streamed in by a ChunkedLevel
+  def __init__(self, level_path, screen, view_size, npc_count=0, light_pool=None, seed=None, chunked=False):
+    if chunked:
+      self.level = ChunkedLevel(level_path, screen)
+    else:
+      self.level = Level(level_path, screen)
+    self.player_cam = Camera((85,85), view_size[0], view_size[1])
+    self.origin_cam = Camera((0,0), view_size[0], view_size[1])
+    self.player = Player("resources/robodude.png", screen, (85,85), self.player_cam)
+    self.entities = [self.player]
+
+    self.entity_store = EntityStore(screen)
+    self.entity_store.add_member(self.player)
+    spawn_npcs(self.entity_store, self.level, npc_count, Random(seed))
+
+    self.light_index = LightIndex()
+    self.light_pool = light_pool
+    for entity in self.entities:
+      entity.register_lights(self.light_index, light_pool)
+    self.visible_lights = []
+
+  # get_camera: return the camera looked through while the given keys
+  # are held
+  def get_camera(self, held_keys):
+    if ORIGIN_CAMERA_KEY in held_keys:
+      return self.origin_cam
+    return self.player.camera
+
+  # step: simulate step_time ms, with the given keys held
+  def step(self, step_time, held_keys):
+    for keydown in held_keys:
+      if keydown in WASD_KEYS:
+        self.player.movement_handler(keydown)
+    self.entity_store.step(step_time, self.level)
+
+  # update_view: bring everything which is only drawn in line with the
+  # time alpha of the way from the last step to the next, with the
+  # given keys held and the mouse at mouse_pos (the real mouse, if
+  # None). Returns the camera to draw through, and the active views
+  def update_view(self, alpha, held_keys, mouse_pos=None):
+    camera = self.get_camera(held_keys)
+    # lights are culled against where the camera was, which VIEW_MARGIN
+    # allows for, and rendered against where it is now
+    self.light_index.set_views([camera.get_corners()])
+    self.player.update_view(alpha, self.level, camera, mouse_pos)
+    self.entity_store.interpolate(alpha)
+    self.entity_store.update_lights(self.level, self.light_index, self.light_pool)
+
+    views = [camera.get_corners()]
+    self.light_index.set_views(views)
+    self.level.update_residency(views + [light.get_projection_bounds() for light in self.visible_lights])
+    return camera, views
+
+  # gather_lights: wait for the light updates of this frame, and return
+  # the lights near the views, which are the ones which were updated
+  def gather_lights(self):
+    if self.light_pool is not None:
+      with frame_profiler.stage("light_pool"):
+        self.light_pool.gather()
+    self.visible_lights = self.light_index.visible_lights()
+    return self.visible_lights
+
+  # close: stop the level's and the light pool's background work
+  def close(self):
+    self.level.close()
+    if self.light_pool is not None:
+      self.light_pool.close()
+
+# spawn_npcs: add count robots wandering in random directions, at
+# random open spots of the level. Raises ValueError if no open spot
+# turns up in SPAWN_ATTEMPTS tries
+def spawn_npcs(entity_store, level, count, rand):
+  size = (32, 32)
+  right = level.width*level.tile_dimension - size[0]//2
+  bottom = level.height*level.tile_dimension - size[1]//2
+  for spawned in range(count):
+    for attempt in range(SPAWN_ATTEMPTS):
+      x = rand.randint(size[0]//2, right)
+      y = rand.randint(size[1]//2, bottom)
+      if not level.solidity_at((x - size[0]/2, y - size[1]/2), (x + size[0]/2, y + size[1]/2))[0].any():
+        break
+    else:
+      raise ValueError("no open %dx%d spot to spawn an NPC in after %d tries" % (size + (SPAWN_ATTEMPTS,)))
+    direction = Vec2d(1, 0).rotated_degrees(rand.randint(0, 359))
+    entity_store.add((x, y), tuple(direction), 2, size, "resources/robodude.png")